@@ -1,8 +1,20 @@
 import os
 import hashlib
 import json
-import gzip
 import argparse
+import concurrent.futures
+import functools
+import shutil
+import tempfile
+import updater.codec
+import updater.delta
+import updater.digest
+import updater.manifest
+
+CHUNK_SIZE = 1024 * 1024
+DELTA_MIN_SIZE = 64 * 1024
+DELTA_MAX_RATIO = 0.5
+BUNDLE_MEMBER_SIZE = 64 * 1024
 
 
 class Packager:
@@ -18,21 +30,91 @@ class Packager:
     input_dir = None
     output_dir = None
     output_file = None
+    jobs = 1
+    incremental = False
+    store = False
+    deltas = 0
+    chunk_size = 0
+    bundle_size = 0
+    codec = updater.codec.DEFAULT_CODEC
+    select_codec = None
+    hash_algorithm = updater.digest.DEFAULT_ALGORITHM
+    pending_files = []
+    previous = None
+    stat_cache = {}
+    previous_stat_cache = {}
     exclude_items = [".git", ".revision"]
 
     def __init__(self):
         # Set up the accepted arguments
         parser = argparse.ArgumentParser(description="NI Update Packager Args")
-        parser.add_argument("-i", "--input", help="Input Directory", required=True)
-        parser.add_argument("-o", "--output", help="Output Directory", required=True)
-        parser.add_argument("-v", "--version", help="Module Version", required=True)
-        parser.add_argument("-H", "--host", help="Host Name", required=True)
+        parser.add_argument("-i", "--input", help="Input Directory")
+        parser.add_argument("-o", "--output", help="Output Directory")
+        parser.add_argument("-v", "--version", help="Module Version")
+        parser.add_argument("-H", "--host", help="Host Name")
         parser.add_argument("-f", "--file", help="File Name", required=False)
+        parser.add_argument("-j", "--jobs", help="Number of packaging processes", type=int, default=1)
+        parser.add_argument("-I", "--incremental", help="Only repackage files changed since the last run",
+                            action="store_true")
+        parser.add_argument("-s", "--store", help="Store files once by content hash instead of per version",
+                            action="store_true")
+        parser.add_argument("-d", "--deltas", help="Create binary deltas from the previous DELTAS versions",
+                            type=int, default=0)
+        parser.add_argument("-c", "--chunk-size", help="Record per-chunk hashes of files larger than CHUNK_SIZE MiB",
+                            type=int, default=0)
+        parser.add_argument("-B", "--bundle-size", help="Pack small files into bundles of up to BUNDLE_SIZE KiB",
+                            type=int, default=0)
+        parser.add_argument("-C", "--codec", help="Compression codec, or auto to pick one per file",
+                            choices=["auto"] + updater.codec.CODEC_ORDER, default=updater.codec.DEFAULT_CODEC)
+        parser.add_argument("-b", "--bandwidth", help="Client download speed in KiB/s assumed by the auto codec",
+                            type=int, default=2048)
+        parser.add_argument("-a", "--hash-algorithm", help="Algorithm to hash files with",
+                            choices=updater.digest.ALGORITHM_ORDER, default=updater.digest.DEFAULT_ALGORITHM)
+        parser.add_argument("--gc", help="Prune blobs not referenced by the newest RETAIN versions",
+                            metavar="RETAIN", type=int)
+        parser.add_argument("--benchmark-hashes", help="Measure how fast each hash algorithm runs and exit",
+                            action="store_true")
+        parser.add_argument("--benchmark-codecs", help="Measure how fast each codec decodes, compared with the "
+                                                       "reference speeds the auto codec assumes, and exit",
+                            action="store_true")
         # Store the arguments
         args = parser.parse_args()
-        self.input_dir = os.path.abspath(args.input)
+        if args.benchmark_hashes:
+            for algorithm, speed in updater.digest.measure_hash_speeds().items():
+                print("{0}: {1:.0f} MiB/s".format(algorithm, speed / 1024 / 1024))
+            exit()
+        if args.benchmark_codecs:
+            for codec, speed in updater.codec.measure_decode_speeds().items():
+                print("{0}: {1:.0f} MiB/s, reference {2:.0f} MiB/s".format(
+                    codec, speed / 1024 / 1024, updater.codec.DECODE_SPEEDS[codec] / 1024 / 1024))
+            exit()
+        if not args.output:
+            parser.error("the following arguments are required: -o/--output")
         self.output_dir = os.path.abspath(args.output)
+        # Garbage collection can run on its own, without packaging a new version
+        if args.gc is not None and not args.input:
+            self.collect_garbage(args.gc)
+            exit()
+        if not args.input or not args.version:
+            parser.error("the following arguments are required: -i/--input, -v/--version")
+        self.input_dir = os.path.abspath(args.input)
         self.output["version"] = args.version
+        self.jobs = max(1, args.jobs)
+        self.incremental = args.incremental
+        self.store = args.store
+        self.deltas = max(0, args.deltas)
+        self.chunk_size = max(0, args.chunk_size) * 1024 * 1024
+        self.bundle_size = max(0, args.bundle_size) * 1024
+        self.codec = args.codec
+        self.hash_algorithm = args.hash_algorithm
+        if self.hash_algorithm != updater.digest.DEFAULT_ALGORITHM:
+            # The field is left out of SHA-1 manifests, so they stay exactly as they were
+            self.output["hash_algorithm"] = self.hash_algorithm
+        if self.codec == "auto":
+            # Decode speeds are measured once so every file in the run is judged the same way
+            self.select_codec = functools.partial(updater.codec.select_codec, bandwidth=args.bandwidth * 1024)
+        if self.store:
+            self.output["store"] = "blobs"
         if args.file:
             self.output_file = args.file
         else:
@@ -52,8 +134,18 @@ class Packager:
         # Begin standard operations
         self.check_input_dir()
         self.check_output_dir()
+        if self.incremental:
+            self.load_previous_run()
         self.process_dir(self.input_dir)
+        self.process_files()
+        if self.bundle_size:
+            self.process_bundles()
+        if self.deltas:
+            self.process_deltas()
+        self.create_stat_cache()
         self.create_output_file()
+        if args.gc is not None:
+            self.collect_garbage(args.gc)
 
     def check_input_dir(self):
         # Check that the input directory exists
@@ -65,29 +157,149 @@ class Packager:
         # Check that the output directory exists
         if not os.path.exists(self.output_dir):
             os.mkdir(self.output_dir)
-        if not os.path.exists(os.path.join(self.output_dir, self.output["version"])):
+        if not os.path.exists(os.path.join(self.output_dir, "versions")):
+            os.mkdir(os.path.join(self.output_dir, "versions"))
+        if self.store:
+            if not os.path.exists(os.path.join(self.output_dir, "blobs")):
+                os.mkdir(os.path.join(self.output_dir, "blobs"))
+        elif not os.path.exists(os.path.join(self.output_dir, self.output["version"])):
             os.mkdir(os.path.join(self.output_dir, self.output["version"]))
 
-    def compress_file(self, path):
-        # Compress the file and put it in the output directory
-        original_file = open(path, "rb")
-        relative_path = os.path.relpath(path, self.input_dir)
-        print("Compressing " + relative_path)
-        gz_file = gzip.open(os.path.join(self.output_dir, self.output["version"], relative_path + ".gz"), "wb")
-        gz_file.writelines(original_file)
-        gz_file.close()
-        original_file.close()
+    def collect_garbage(self, retain):
+        # Remove old version manifests and any blobs the retained versions no longer reference
+        versions_dir = os.path.join(self.output_dir, "versions")
+        blobs_dir = os.path.join(self.output_dir, "blobs")
+        if not os.path.exists(versions_dir) or not os.path.exists(blobs_dir):
+            print("Error: No content store found in " + self.output_dir)
+            return
+        manifests = []
+        for item in os.listdir(versions_dir):
+            with open(os.path.join(versions_dir, item), "rt") as file:
+                manifests.append((item, json.load(file)))
+        manifests.sort(key=lambda manifest: version_key(manifest[1]["version"]), reverse=True)
+        referenced = set()
+        referenced_deltas = set()
+        referenced_bundles = set()
+        for item, manifest in manifests[:max(1, retain)]:
+            for entry in list_entries(manifest["files"]):
+                if "store" in manifest:
+                    referenced.add(entry["hash"])
+                if "bundle" in entry:
+                    referenced_bundles.add(entry["bundle"][0])
+                for base_hash in entry.get("deltas", []):
+                    referenced_deltas.add(base_hash + "_" + entry["hash"] + updater.codec.get_extension("gzip"))
+        for item, manifest in manifests[max(1, retain):]:
+            print("Removing version " + manifest["version"])
+            os.remove(os.path.join(versions_dir, item))
+        removed = 0
+        for path, dirs, files in os.walk(blobs_dir):
+            for item in files:
+                if item.split(".")[0] not in referenced:
+                    os.remove(os.path.join(path, item))
+                    removed += 1
+        print("Removed " + str(removed) + " unreferenced blobs.")
+        deltas_dir = os.path.join(self.output_dir, "deltas")
+        if os.path.exists(deltas_dir):
+            removed = 0
+            for item in os.listdir(deltas_dir):
+                if item not in referenced_deltas:
+                    os.remove(os.path.join(deltas_dir, item))
+                    removed += 1
+            print("Removed " + str(removed) + " unreferenced deltas.")
+        bundles_dir = os.path.join(self.output_dir, "bundles")
+        if os.path.exists(bundles_dir):
+            removed = 0
+            for item in os.listdir(bundles_dir):
+                if item not in referenced_bundles:
+                    os.remove(os.path.join(bundles_dir, item))
+                    removed += 1
+            print("Removed " + str(removed) + " unreferenced bundles.")
+
+    def create_stat_cache(self):
+        # Save the stat data of every packaged file for the next incremental run
+        file = open(os.path.join(self.output_dir, self.output_file + ".cache"), "wt")
+        file.write(json.dumps({"version": self.output["version"], "files": self.stat_cache},
+                              separators=(",", ":"), sort_keys=True))
+        file.close()
 
     def create_output_file(self):
         # Save the hashes to a file
+        self.output["dirs"] = {}
+        merkle_hash(self.output["files"], [], self.output["dirs"])
+        text = json.dumps(self.output, separators=(",", ":"), sort_keys=True, indent=4)
         file = open(os.path.join(self.output_dir, self.output_file), "wt")
-        file.write(json.dumps(self.output, separators=(",", ":"), sort_keys=True, indent=4))
+        file.write(text)
+        file.close()
+        # Clients read the compact copy; the JSON one stays for older clients and for later packager runs
+        file = open(os.path.join(self.output_dir, os.path.splitext(self.output_file)[0] + ".pack"), "wb")
+        file.write(updater.manifest.encode(self.output))
+        file.close()
+        # Keep a copy of every published manifest so old versions can be diffed and garbage collected
+        file = open(os.path.join(self.output_dir, "versions", self.output["version"] + ".json"), "wt")
+        file.write(text)
         file.close()
         print("Hash generation complete.")
-        exit()
+
+    def load_previous_run(self):
+        # Load the previous manifest and stat cache, if both are present
+        manifest_path = os.path.join(self.output_dir, self.output_file)
+        cache_path = os.path.join(self.output_dir, self.output_file + ".cache")
+        if not os.path.exists(manifest_path) or not os.path.exists(cache_path):
+            print("No previous run found, packaging everything.")
+            return
+        with open(manifest_path, "rt") as file:
+            self.previous = json.load(file)
+        with open(cache_path, "rt") as file:
+            cache = json.load(file)
+        # A stat cache from a different run than the manifest can't be trusted
+        if cache["version"] == self.previous["version"]:
+            self.previous_stat_cache = cache["files"]
+
+    def output_path(self, manifest, relative_path, entry):
+        # Return where a manifest's compressed copy of a file is stored
+        extension = updater.codec.get_extension(entry.get("codec", updater.codec.DEFAULT_CODEC))
+        if "store" in manifest:
+            return blob_path(self.output_dir, entry["hash"], extension)
+        return os.path.join(self.output_dir, manifest["version"], relative_path + extension)
+
+    def reuse_output(self, relative_path, stat):
+        # Reuse the previous output of an unchanged file, returning its entry if possible
+        if self.previous_stat_cache.get(relative_path) != stat:
+            return None
+        entry = lookup_entry(self.previous["files"], relative_path)
+        # Files no larger than a chunk are never split, whatever the chunk size
+        chunk_size = self.chunk_size if self.chunk_size and stat[0] > self.chunk_size else 0
+        if not entry or entry.get("chunk_size", 0) != chunk_size:
+            return None
+        if self.previous.get("hash_algorithm", updater.digest.DEFAULT_ALGORITHM) != self.hash_algorithm:
+            return None
+        if self.codec != "auto" and entry.get("codec", updater.codec.DEFAULT_CODEC) != self.codec:
+            return None
+        # Deltas are relative to the versions before the previous one, and bundles are regrouped, so both are recreated
+        entry = dict(entry)
+        entry.pop("deltas", None)
+        entry.pop("bundle", None)
+        previous_path = self.output_path(self.previous, relative_path, entry)
+        output_path = self.output_path(self.output, relative_path, entry)
+        if self.store:
+            # Blobs are shared between versions, so an existing blob is all that's needed
+            if not os.path.exists(output_path):
+                return None
+        else:
+            if not os.path.exists(previous_path):
+                return None
+            if not os.path.exists(output_path):
+                try:
+                    os.link(previous_path, output_path)
+                except OSError:
+                    shutil.copy2(previous_path, output_path)
+        # Manifests from before sizes were recorded don't have them
+        entry.setdefault("size", stat[0])
+        entry.setdefault("csize", os.path.getsize(output_path))
+        return entry
 
     def process_dir(self, path):
-        # Loop through the input directory to generate hashes
+        # Loop through the input directory to find the files to package
         for item in os.listdir(path):
             if item in self.exclude_items:
                 continue
@@ -95,28 +307,262 @@ class Packager:
             relative_path = os.path.relpath(absolute_path, self.input_dir)
             if os.path.isdir(absolute_path):
                 output_path = os.path.join(self.output_dir, self.output["version"], relative_path)
-                if not os.path.exists(output_path):
+                if not self.store and not os.path.exists(output_path):
                     os.mkdir(output_path)
                 self.process_dir(absolute_path)
             else:
-                file_hash = generate_hash(absolute_path)
-                self.record_hash(relative_path, file_hash)
-                self.compress_file(absolute_path)
+                self.pending_files.append(relative_path)
+
+    def process_files(self):
+        # Hash and compress the pending files, fanning out across processes if requested
+        changed_files = []
+        for relative_path in self.pending_files:
+            stat = file_stat(os.path.join(self.input_dir, relative_path))
+            self.stat_cache[relative_path] = stat
+            entry = self.reuse_output(relative_path, stat)
+            if entry:
+                self.record_entry(relative_path).update(entry)
+            else:
+                changed_files.append(relative_path)
+        print("Reusing " + str(len(self.pending_files) - len(changed_files)) + " unchanged files.")
+        self.pending_files = changed_files
+        if self.store:
+            worker = functools.partial(package_file, self.input_dir, self.output_dir, store=True,
+                                       chunk_size=self.chunk_size, codec=self.codec, select_codec=self.select_codec,
+                                       hash_algorithm=self.hash_algorithm)
+        else:
+            worker = functools.partial(package_file, self.input_dir,
+                                       os.path.join(self.output_dir, self.output["version"]),
+                                       chunk_size=self.chunk_size, codec=self.codec, select_codec=self.select_codec,
+                                       hash_algorithm=self.hash_algorithm)
+        if self.jobs > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                # Results come back in submission order, so the manifest matches a serial run
+                results = list(executor.map(worker, self.pending_files,
+                                            chunksize=max(1, len(self.pending_files) // (self.jobs * 16))))
+        else:
+            results = list(map(worker, self.pending_files))
+        for relative_path, entry in results:
+            self.record_entry(relative_path).update(entry)
+
+    def create_bundle(self, members):
+        # Concatenate the compressed copies of some files into a bundle named by its hash
+        data = b""
+        for relative_path, entry, output_path in members:
+            with open(output_path, "rb") as file:
+                member_data = file.read()
+            entry["bundle"] = [None, len(data), len(member_data)]
+            data += member_data
+        bundle_id = hashlib.sha1(data).hexdigest()
+        bundle_path = os.path.join(self.output_dir, "bundles", bundle_id)
+        if not os.path.exists(bundle_path):
+            with open(bundle_path, "wb") as file:
+                file.write(data)
+        for relative_path, entry, output_path in members:
+            entry["bundle"][0] = bundle_id
+
+    def process_bundles(self):
+        # Pack the small files of each directory into bundles so clients can fetch many of them in one request
+        directories = {}
+        for relative_path in sorted(self.stat_cache):
+            if self.stat_cache[relative_path][0] < BUNDLE_MEMBER_SIZE:
+                directories.setdefault(os.path.dirname(relative_path), []).append(relative_path)
+        if directories and not os.path.exists(os.path.join(self.output_dir, "bundles")):
+            os.mkdir(os.path.join(self.output_dir, "bundles"))
+        for directory in sorted(directories):
+            members = []
+            size = 0
+            for relative_path in directories[directory]:
+                entry = lookup_entry(self.output["files"], relative_path)
+                output_path = self.output_path(self.output, relative_path, entry)
+                member_size = os.path.getsize(output_path)
+                if members and size + member_size > self.bundle_size:
+                    if len(members) > 1:
+                        self.create_bundle(members)
+                    members = []
+                    size = 0
+                members.append((relative_path, entry, output_path))
+                size += member_size
+            if len(members) > 1:
+                self.create_bundle(members)
+
+    def process_deltas(self):
+        # Create deltas from the same file in each of the previous versions
+        versions_dir = os.path.join(self.output_dir, "versions")
+        manifests = []
+        for item in os.listdir(versions_dir):
+            with open(os.path.join(versions_dir, item), "rt") as file:
+                manifest = json.load(file)
+            # Deltas are named after the client's hash of its copy, so they need the same algorithm
+            if manifest["version"] != self.output["version"] and \
+                    manifest.get("hash_algorithm", updater.digest.DEFAULT_ALGORITHM) == self.hash_algorithm:
+                manifests.append(manifest)
+        manifests.sort(key=lambda manifest: version_key(manifest["version"]), reverse=True)
+        tasks = []
+        for relative_path in self.stat_cache:
+            # Small files are cheap enough to download whole
+            if self.stat_cache[relative_path][0] < DELTA_MIN_SIZE:
+                continue
+            entry = lookup_entry(self.output["files"], relative_path)
+            bases = []
+            for manifest in manifests[:self.deltas]:
+                base_entry = lookup_entry(manifest["files"], relative_path)
+                if not base_entry or base_entry["hash"] == entry["hash"] or \
+                        base_entry["hash"] in [base[0] for base in bases]:
+                    continue
+                base_path = self.output_path(manifest, relative_path, base_entry)
+                if os.path.exists(base_path):
+                    bases.append((base_entry["hash"], base_path,
+                                  base_entry.get("codec", updater.codec.DEFAULT_CODEC)))
+            if bases:
+                tasks.append((relative_path, entry["hash"], self.output_path(self.output, relative_path, entry),
+                              bases))
+        deltas_dir = os.path.join(self.output_dir, "deltas")
+        if tasks and not os.path.exists(deltas_dir):
+            os.mkdir(deltas_dir)
+        worker = functools.partial(package_deltas, self.input_dir, deltas_dir)
+        if self.jobs > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                results = list(executor.map(worker, tasks))
+        else:
+            results = list(map(worker, tasks))
+        for relative_path, base_hashes in results:
+            if base_hashes:
+                self.record_entry(relative_path)["deltas"] = base_hashes
 
-    def record_hash(self, relative_path, file_hash):
-        # Record a file's hash to the output array
+    def record_entry(self, relative_path):
+        # Return a file's entry in the output array, creating it if needed
         path = split_path(relative_path)
         _current_key = self.output["files"]
         for i in range(len(path)):
             if not path[i] in _current_key:
                 _current_key[path[i]] = {}
             _current_key = _current_key[path[i]]
-        _current_key["hash"] = file_hash
+        return _current_key
 
 
-def generate_hash(path):
-    # Return the hash of the file
-    return hashlib.sha1(open(path, 'rb').read()).hexdigest()
+def blob_path(output_dir, file_hash, extension):
+    # Return the content store location of a file
+    return os.path.join(output_dir, "blobs", file_hash[:2], file_hash + extension)
+
+
+def file_stat(path):
+    # Return the stat data used to detect whether a file changed between runs
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def list_entries(files):
+    # Yield every file entry in a manifest's file tree
+    for key in files:
+        if "hash" in files[key]:
+            yield files[key]
+        else:
+            yield from list_entries(files[key])
+
+
+def lookup_entry(files, relative_path):
+    # Find a file's entry in a manifest's file tree
+    _current_key = files
+    for key in split_path(relative_path):
+        if key not in _current_key:
+            return None
+        _current_key = _current_key[key]
+    return _current_key if "hash" in _current_key else None
+
+
+def merkle_hash(files, path, dirs):
+    # Hash a directory from the names and hashes of its children, recording every directory's hash in dirs
+    dir_hash = hashlib.sha1()
+    for key in sorted(files):
+        if "hash" in files[key]:
+            dir_hash.update((key + "\0f" + files[key]["hash"] + "\n").encode("utf-8"))
+        else:
+            dir_hash.update((key + "\0d" + merkle_hash(files[key], path + [key], dirs) + "\n").encode("utf-8"))
+    dirs["/".join(path)] = dir_hash.hexdigest()
+    return dirs["/".join(path)]
+
+
+def package_deltas(input_dir, deltas_dir, task):
+    # Create the deltas for a single file, keeping only those which are worth downloading
+    relative_path, file_hash, output_path, bases = task
+    with open(os.path.join(input_dir, relative_path), "rb") as file:
+        target = file.read()
+    full_size = os.path.getsize(output_path)
+    base_hashes = []
+    for base_hash, base_path, base_codec in bases:
+        delta_path = os.path.join(deltas_dir, base_hash + "_" + file_hash + updater.codec.get_extension("gzip"))
+        if not os.path.exists(delta_path):
+            print("Creating delta " + relative_path + " " + base_hash)
+            with open(base_path, "rb") as file:
+                base = updater.codec.decompress(base_codec, file.read())
+            delta = updater.delta.create_delta(base, target)
+            if delta is None:
+                print("Skipping delta " + relative_path + " " + base_hash + ", the versions are unrelated")
+                continue
+            delta = updater.codec.compress("gzip", delta)
+            if len(delta) > full_size * DELTA_MAX_RATIO:
+                continue
+            with open(delta_path, "wb") as file:
+                file.write(delta)
+        base_hashes.append(base_hash)
+    return relative_path, sorted(base_hashes)
+
+
+def package_file(input_dir, output_dir, relative_path, store=False, chunk_size=0, codec=updater.codec.DEFAULT_CODEC,
+                 select_codec=None, hash_algorithm=updater.digest.DEFAULT_ALGORITHM):
+    # Hash and compress a single file in one pass; runs in a worker process when packaging in parallel
+    absolute_path = os.path.join(input_dir, relative_path)
+    print("Compressing " + relative_path)
+    entry = {}
+    file_hash = updater.digest.new(hash_algorithm)
+    with open(absolute_path, "rb") as original_file:
+        size = os.fstat(original_file.fileno()).st_size
+        if select_codec:
+            # Judge the file by its start rather than compressing all of it with every codec
+            codec = select_codec(original_file.read(updater.codec.SAMPLE_SIZE))
+            original_file.seek(0)
+        if codec != updater.codec.DEFAULT_CODEC:
+            entry["codec"] = codec
+        if store:
+            # The blob name isn't known until the file is hashed, so compress to a temporary file first
+            handle, output_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.join(output_dir, "blobs"))
+            os.close(handle)
+        else:
+            output_path = os.path.join(output_dir, relative_path) + updater.codec.get_extension(codec)
+            # The old output may be hard linked into another version, so replace it rather than overwrite it
+            if os.path.exists(output_path):
+                os.remove(output_path)
+        with open(output_path, "wb") as raw_file:
+            if chunk_size and size > chunk_size:
+                # Compress each chunk as its own member so a client can fetch and repair it alone
+                entry["chunk_size"] = chunk_size
+                entry["chunks"] = []
+                for chunk in iter(lambda: original_file.read(chunk_size), b""):
+                    offset = raw_file.tell()
+                    raw_file.write(updater.codec.compress(codec, chunk))
+                    file_hash.update(chunk)
+                    entry["chunks"].append([updater.digest.get_hash(chunk, hash_algorithm), offset,
+                                            raw_file.tell() - offset])
+            else:
+                # Feed the hash and the compressor from the same fixed-size buffer
+                compressor = updater.codec.get_compressor(codec)
+                for chunk in iter(lambda: original_file.read(CHUNK_SIZE), b""):
+                    file_hash.update(chunk)
+                    raw_file.write(compressor.compress(chunk))
+                raw_file.write(compressor.flush())
+            # Clients check the size before hashing, and the compressed size tells them how much to download
+            entry["size"] = size
+            entry["csize"] = raw_file.tell()
+    entry["hash"] = file_hash.hexdigest()
+    if store:
+        final_path = blob_path(output_dir, entry["hash"], updater.codec.get_extension(codec))
+        if os.path.exists(final_path):
+            os.remove(output_path)
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(output_path, final_path)
+    return relative_path, entry
 
 
 def split_path(path):
@@ -124,4 +570,11 @@ def split_path(path):
     path = os.path.normcase(path)
     return path.split(os.path.sep)
 
-Packager()
+
+def version_key(version):
+    # Return a sort key which orders version strings numerically where possible
+    return [(0, int(part), "") if part.isdigit() else (1, 0, part) for part in version.split(".")]
+
+
+if __name__ == "__main__":
+    Packager()
@@ -1,5 +1,9 @@
+import multiprocessing
 import updater.main
 import win32com.client
 win32com.client.gencache.is_readonly=False
 
-updater.main.Main()
+if __name__ == "__main__":
+    # Validation can hash files in worker processes, which start by importing this script
+    multiprocessing.freeze_support()
+    updater.main.Main()
@@ -0,0 +1,639 @@
+import asyncio
+import certifi
+import collections
+import concurrent.futures
+import http.client
+import io
+import os.path
+import socket
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
+import updater.concurrency
+import updater.connection
+import updater.stream
+
+REDIRECT_CODES = updater.connection.REDIRECT_CODES
+
+
+class AsyncConnectionPool:
+
+    block_size = 64 * 1024
+    max_idle = 8
+    max_redirects = 5
+    timeout = 30
+
+    def __init__(self, ssl_context=None, timeout=None):
+        """ Keep HTTP connections open between requests made from one event loop.
+
+        This is the asyncio counterpart of updater.connection.ConnectionPool, so a single thread can keep hundreds of
+        transfers going at once.  Each host name is only resolved once for the life of the pool, and every address it
+        resolves to is tried in turn.  Proxies aren't supported, so the caller has to check for them itself.
+
+        :param ssl_context: The SSL context to use for https connections
+        :param float timeout: How many seconds to wait for the server before giving up, per read
+        """
+        if not ssl_context:
+            ssl_context = ssl.create_default_context()
+            ssl_context.load_verify_locations(certifi.where())
+        self.ssl_context = ssl_context
+        if timeout:
+            self.timeout = timeout
+        self.idle = {}
+        self.addresses = {}
+        self.resolved = {}
+        self.counters = {"requests": 0, "reused": 0, "opened": 0, "dns_hits": 0, "dns_misses": 0}
+
+    async def request(self, url, headers=None):
+        """ Send a GET request on a pooled connection, following redirects.
+
+        Only the status line and headers have been read when this returns, the body is read from the response.
+
+        :param str url: The URL to request
+        :param dict headers: Extra request headers
+        :return AsyncResponse: The response, which must be closed once it has been read
+        :raise urllib.error.HTTPError: The server answered with an error
+        :raise urllib.error.URLError: The server could not be reached
+        """
+        for redirect in range(self.max_redirects + 1):
+            response = await self.__send(url, headers or {})
+            if response.status not in REDIRECT_CODES or not response.headers.get("Location"):
+                break
+            await response.read_all()
+            response.close()
+            url = urllib.parse.urljoin(url, response.headers["Location"])
+        if not 200 <= response.status < 300:
+            # Read the body now so the connection can go back to the pool
+            error_body = await response.read_all()
+            response.close()
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers,
+                                         io.BytesIO(error_body))
+        return response
+
+    def stats(self):
+        """ Report how often a connection or an address could be reused.
+
+        :return dict: The request, connection and DNS counters, plus the connection and DNS hit rates
+        """
+        return updater.connection.hit_rates(self.counters)
+
+    def close(self):
+        """ Close every idle connection.
+
+        :return:
+        """
+        idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for reader, writer in connections:
+                writer.close()
+
+    def release(self, key, connection, reusable):
+        """ Return a connection to the pool, or close it if it can't carry another request.
+
+        :param tuple key: The scheme, host and port the connection belongs to
+        :param tuple connection: The stream reader and writer
+        :param bool reusable: Whether the last response was read to the end on a connection which stays open
+        :return:
+        """
+        connections = self.idle.setdefault(key, [])
+        if reusable and len(connections) < self.max_idle:
+            connections.append(connection)
+        else:
+            connection[1].close()
+
+    async def __send(self, url, headers):
+        """ Send one request, moving to a fresh connection if a pooled one turns out to have been closed. """
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise urllib.error.URLError("Unsupported scheme: " + parts.scheme)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        headers = dict(headers)
+        headers.setdefault("Host", parts.netloc)
+        headers.setdefault("User-Agent", "Python-urllib")
+        headers.setdefault("Connection", "keep-alive")
+        lines = ["GET " + path + " HTTP/1.1"] + [name + ": " + str(value) for name, value in headers.items()]
+        message = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        self.counters["requests"] += 1
+        while True:
+            connection, reused = await self.__acquire(key)
+            reader, writer = connection
+            try:
+                writer.write(message)
+                status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+                if not status_line:
+                    raise ConnectionResetError("Connection closed before the response")
+                header_lines = []
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), self.timeout)
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    header_lines.append(line)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                writer.close()
+                if reused:
+                    # The server dropped the idle connection, so the request never reached it
+                    continue
+                raise urllib.error.URLError(e)
+            except (OSError, ValueError, asyncio.TimeoutError) as e:
+                writer.close()
+                raise urllib.error.URLError(e)
+            except asyncio.CancelledError:
+                # Nobody is waiting for the response any more, such as the loser of a hedged request
+                writer.close()
+                raise
+            if reused:
+                self.counters["reused"] += 1
+            version, status, reason = (status_line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+            response_headers = http.client.parse_headers(io.BytesIO(b"".join(header_lines) + b"\r\n"))
+            return AsyncResponse(self, key, connection, int(status), reason, response_headers, version)
+
+    async def __acquire(self, key):
+        """ Take an idle connection for a host, or open a new one.
+
+        :return tuple: The connection and whether it was reused
+        """
+        connections = self.idle.get(key)
+        while connections:
+            connection = connections.pop()
+            if not connection[0].at_eof():
+                return connection, True
+            connection[1].close()
+        self.counters["opened"] += 1
+        scheme, host, port = key
+        addresses = await self.__resolve(host, port)
+        error = None
+        for address in addresses:
+            try:
+                if scheme == "https":
+                    # Connect to the cached address, while TLS still checks the certificate against the host name
+                    connection = await asyncio.wait_for(asyncio.open_connection(
+                        address, port, ssl=self.ssl_context, server_hostname=host), self.timeout)
+                else:
+                    connection = await asyncio.wait_for(asyncio.open_connection(address, port), self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                error = e
+                continue
+            if address != addresses[0]:
+                # Try the address which answered first from now on
+                addresses.remove(address)
+                addresses.insert(0, address)
+            return connection, False
+        raise urllib.error.URLError(error)
+
+    async def __resolve(self, host, port):
+        """ Resolve a host name once per session, sharing the lookup between transfers which start together.
+
+        :return list: The addresses to connect to, in the order to try them
+        """
+        lookup = self.addresses.get((host, port))
+        if lookup is None:
+            self.counters["dns_misses"] += 1
+            lookup = asyncio.ensure_future(asyncio.get_event_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM))
+            self.addresses[(host, port)] = lookup
+        else:
+            self.counters["dns_hits"] += 1
+        try:
+            # Shield the shared lookup so one cancelled transfer doesn't cancel it for the others
+            info = await asyncio.shield(lookup)
+        except OSError as e:
+            self.addresses.pop((host, port), None)
+            raise urllib.error.URLError(e)
+        if (host, port) not in self.resolved:
+            self.resolved[(host, port)] = updater.connection.unique_addresses(info)
+        return self.resolved[(host, port)]
+
+
+class AsyncResponse:
+
+    def __init__(self, pool, key, connection, status, reason, headers, version):
+        """ A response whose body is read a block at a time, handing its connection back to the pool when closed.
+
+        :param AsyncConnectionPool pool: The pool the connection came from
+        :param tuple key: The scheme, host and port of the connection
+        :param tuple connection: The stream reader and writer
+        :param int status: The HTTP status
+        :param str reason: The HTTP reason phrase
+        :param headers: The response headers
+        :param str version: The HTTP version of the response
+        """
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.chunked = headers.get("Transfer-Encoding", "").lower() == "chunked"
+        self.chunk_left = 0
+        if status in (204, 304) or 100 <= status < 200:
+            self.remaining = 0
+        elif self.chunked:
+            self.remaining = None
+        elif headers.get("Content-Length", "").isdigit():
+            self.remaining = int(headers["Content-Length"])
+        else:
+            self.remaining = None
+        connection_header = headers.get("Connection", "").lower()
+        self.keep_alive = connection_header != "close" and (version == "HTTP/1.1" or connection_header == "keep-alive")
+        self.finished = False
+
+    async def read(self):
+        """ Read the next block of the body.
+
+        :return bytes: The block, or an empty string once the body has been read
+        :raise urllib.error.URLError: The connection was lost part way through the body
+        """
+        if self.finished:
+            return b""
+        reader = self.connection[0]
+        try:
+            if self.chunked:
+                if self.chunk_left == 0:
+                    size_line = await asyncio.wait_for(reader.readline(), self.pool.timeout)
+                    self.chunk_left = int(size_line.split(b";")[0].strip() or b"0", 16)
+                    if self.chunk_left == 0:
+                        # Skip any trailers
+                        while (await asyncio.wait_for(reader.readline(), self.pool.timeout)) not in (b"\r\n", b""):
+                            pass
+                        self.finished = True
+                        return b""
+                data = await asyncio.wait_for(reader.read(min(self.chunk_left, self.pool.block_size)),
+                                              self.pool.timeout)
+                if not data:
+                    raise http.client.IncompleteRead(b"")
+                self.chunk_left -= len(data)
+                if self.chunk_left == 0:
+                    await asyncio.wait_for(reader.readexactly(2), self.pool.timeout)
+                return data
+            if self.remaining == 0:
+                self.finished = True
+                return b""
+            size = self.pool.block_size if self.remaining is None else min(self.remaining, self.pool.block_size)
+            data = await asyncio.wait_for(reader.read(size), self.pool.timeout)
+            if not data:
+                if self.remaining is not None:
+                    raise http.client.IncompleteRead(b"", self.remaining)
+                # The body runs until the server closes the connection
+                self.keep_alive = False
+                self.finished = True
+                return b""
+            if self.remaining is not None:
+                self.remaining -= len(data)
+            return data
+        except (OSError, ValueError, http.client.HTTPException, asyncio.TimeoutError,
+                asyncio.IncompleteReadError) as e:
+            self.keep_alive = False
+            self.finished = True
+            raise urllib.error.URLError(e)
+
+    async def read_all(self):
+        """ Read the rest of the body.
+
+        :return bytes:
+        """
+        blocks = []
+        while True:
+            data = await self.read()
+            if not data:
+                return b"".join(blocks)
+            blocks.append(data)
+
+    def close(self):
+        if self.connection is not None:
+            self.pool.release(self.key, self.connection, self.finished and self.keep_alive)
+            self.connection = None
+
+
+class AsyncDownloadEngine:
+
+    workers = 4
+
+    def __init__(self, handler, *, callback=None, destination):
+        """ Download the files on a HashHandler's queue as coroutines on one event loop, in a thread of its own.
+
+        Each transfer is a coroutine rather than a thread, so hundreds of them can run at once.  Decompressing, hashing
+        and writing happen on a small thread pool, and a transfer waits for each block to be written before reading the
+        next, so a slow disk pushes back on the network instead of piling data up in memory.  The handler keeps the
+        queue, counters, mirror scheduling, retry policy and range planning, this only does the I/O.
+
+        :param updater.hash.HashHandler handler: The handler whose download queue to work through
+        :param callable callback: A callback function to run after each download
+        :param str destination: The location to save the files
+        """
+        self.handler = handler
+        self.callback = callback
+        self.destination = destination
+        self.pool = AsyncConnectionPool(handler.ssl_context, handler.request_timeout)
+        self.segment_slots = None
+        self.thread = None
+
+    def start(self):
+        """ Start the event loop thread.
+
+        :return:
+        """
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop taking files off the queue, and wait for the event loop to finish the ones it already took.
+
+        :return:
+        """
+        # The queue has no way to wake a waiting get, so hand the feeder a marker telling it to stop
+        self.handler.download_queue.put(None)
+        self.thread.join()
+
+    def __run(self):
+        """ Run the event loop until the engine is stopped, then close its connections and threads. """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        loop.set_default_executor(executor)
+        # Waiting for the queue and for the concurrency controller blocks, so it gets a thread of its own
+        feeder = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.segment_slots = asyncio.Semaphore(self.handler.segment_threads)
+        try:
+            loop.run_until_complete(self.__feed(feeder))
+        finally:
+            self.pool.close()
+            # Let the closed connections finish shutting down before the loop goes
+            loop.run_until_complete(asyncio.sleep(0))
+            feeder.shutdown(wait=False)
+            executor.shutdown(wait=False)
+            loop.close()
+
+    async def __feed(self, feeder):
+        """ Start a transfer for each file as the queue and the concurrency controller allow, until stopped.
+
+        :param concurrent.futures.Executor feeder: The thread to wait for the next file on
+        """
+        loop = asyncio.get_event_loop()
+        transfers = set()
+        while True:
+            entry = await loop.run_in_executor(feeder, self.__next_entry)
+            if entry is None:
+                break
+            transfer = asyncio.ensure_future(self.__transfer(entry))
+            transfers.add(transfer)
+            transfer.add_done_callback(transfers.discard)
+        if transfers:
+            await asyncio.wait(transfers)
+
+    def __next_entry(self):
+        """ Wait for the next file on the queue, then for the concurrency controller to let another transfer run.
+
+        :return dict: The file's entry, or None once the engine has been stopped
+        """
+        entry = self.handler.download_queue.get()
+        if entry is None:
+            self.handler.download_queue.task_done()
+            return None
+        self.handler.download_concurrency.acquire()
+        return entry
+
+    async def __transfer(self, entry):
+        """ Download one file or bundle, retrying a file as the handler's retry policy allows.
+
+        :param dict entry: The file's entry in the hash dictionary, or a bundle task
+        """
+        handler = self.handler
+        loop = asyncio.get_event_loop()
+        if "members" in entry:
+            await self.__download_bundle(entry)
+        else:
+            while True:
+                try:
+                    entry["attempted"] += 1
+                    path = os.path.join(self.destination, entry["path"], entry["name"])
+                    # Patching and repairing work on the local copy in place, so they run on a thread
+                    if not await loop.run_in_executor(None, handler._update_local_copy, entry, path):
+                        await self.__download_file(entry, path)
+                    handler._file_downloaded(entry, path)
+                    break
+                except:
+                    delay = handler._retry_delay(entry)
+                    if delay is None:
+                        break
+                    await asyncio.sleep(delay)
+        handler._download_done(self.callback)
+
+    async def __fetch(self, source, headers=None, writer=None, partial=False, exclude=None):
+        """ Download something from the mirror expected to be fastest right now.
+
+        :param str source: The path to download, relative to a mirror's host
+        :param dict headers: Extra request headers
+        :param updater.stream.VerifiedWriter writer: Where to stream the body to, instead of returning it
+        :param bool partial: Whether to fail unless the server sends the requested range
+        :param list exclude: Mirrors to avoid, which any mirror that fails is added to
+        :return tuple: The response body (empty if it went to the writer), the HTTP status and the response headers
+        :raise ValueError: The server ignored a range which had to be honoured
+        :raise HashHandler.DownloadStalledException: The transfer fell below the minimum throughput
+        """
+        handler = self.handler
+        loop = asyncio.get_event_loop()
+        host, response, start_time = await self.__open(source, headers, writer, exclude)
+        latency = time.perf_counter() - start_time
+        stall = updater.concurrency.StallDetector(handler.stall_throughput, handler.stall_window)
+        blocks = []
+        size = 0
+        try:
+            try:
+                if partial and response.status != 206:
+                    raise ValueError
+                if writer:
+                    handler._start_response(writer, host, response.status, response.headers)
+                while True:
+                    data = await response.read()
+                    if not data:
+                        break
+                    if handler.rate_limiter:
+                        delay = handler.rate_limiter.reserve(len(data))
+                        await asyncio.sleep(delay)
+                        stall.pause(delay)
+                    if stall.update(len(data)):
+                        raise handler.DownloadStalledException("Transfer stalled: " + handler._make_url(host, source))
+                    size += len(data)
+                    if writer:
+                        await loop.run_in_executor(None, writer.write, data)
+                    else:
+                        blocks.append(data)
+            finally:
+                response.close()
+        except:
+            handler._fail_mirror(host, exclude)
+            handler.download_concurrency.record(size, 0, ok=False)
+            raise
+        handler.mirrors.finish(host, size, time.perf_counter() - start_time)
+        handler.download_concurrency.record(size, latency)
+        return b"".join(blocks), response.status, response.headers
+
+    async def __open(self, source, headers, writer, exclude):
+        """ Send a request, hedging it on another mirror if no response comes back in the usual time.
+
+        :param str source: The path to download, relative to a mirror's host
+        :param dict headers: Extra request headers
+        :param updater.stream.VerifiedWriter writer: The download the request continues, if any
+        :param list exclude: Mirrors to avoid, which any mirror that fails is added to
+        :return tuple: The mirror which answered first, its response, and when the request to it was sent
+        :raise: The error from the last request to fail, if they all failed
+        """
+        handler = self.handler
+        attempts = {}
+
+        def send(host):
+            task = asyncio.ensure_future(self.pool.request(handler._make_url(host, source),
+                                                           handler._resume_headers(writer, host, headers)))
+            attempts[task] = (host, time.perf_counter())
+
+        send(handler.mirrors.choose(exclude))
+        handler.requests_sent += 1
+        pending = set(attempts)
+        error = None
+        try:
+            hedge_delay = handler._hedge_delay()
+            if hedge_delay is not None and not (await asyncio.wait(pending, timeout=hedge_delay))[0]:
+                handler.log.info("Hedging slow request: " + source)
+                handler.hedges_sent += 1
+                send(handler.mirrors.choose(list(exclude or []) + [host for host, sent in attempts.values()]))
+                pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = None
+                for task in done:
+                    attempt_host, sent = attempts[task]
+                    try:
+                        response = task.result()
+                    except Exception as e:
+                        handler._fail_mirror(attempt_host, exclude, e)
+                        error = e
+                        continue
+                    if winner is None:
+                        winner = attempt_host, response, sent
+                    else:
+                        response.close()
+                        handler.mirrors.cancel(attempt_host)
+                if winner:
+                    handler.response_latencies.append(time.perf_counter() - winner[2])
+                    return winner
+        finally:
+            # Drop the request which lost the race, or every request if this transfer was cancelled
+            for task in pending:
+                task.cancel()
+                handler.mirrors.cancel(attempts[task][0])
+        raise error
+
+    async def __fetch_segment(self, source, start, end):
+        """ Download one byte range of a file, moving to another mirror if one fails.
+
+        :param str source: The path to download, relative to a mirror's host
+        :param int start: The first byte to download
+        :param int end: The last byte to download
+        :return bytes: The segment
+        :raise ValueError: The segment did not come back as requested
+        """
+        exclude = []
+        for attempt in range(1, self.handler.max_attempts + 1):
+            try:
+                data, status, headers = await self.__fetch(source, {"Range": "bytes={0}-{1}".format(start, end)},
+                                                           partial=True, exclude=exclude)
+                if len(data) != end - start + 1:
+                    raise ValueError
+                return data
+            except asyncio.CancelledError:
+                raise
+            except:
+                if attempt >= self.handler.max_attempts:
+                    raise
+                self.handler.log.warning("Segment failed: {0} bytes {1}-{2}".format(source, start, end), tb=True)
+                await asyncio.sleep(self.handler._backoff(attempt))
+
+    async def __download_file(self, entry, path):
+        """ Stream a file to disk, in parallel segments if it is large enough.
+
+        Segments after the first are fetched ahead and wait in memory until the ones before them are written, but only
+        segment_threads of them across all transfers at once.
+
+        :param dict entry: The file's entry in the hash dictionary
+        :param str path: The location to save the file
+        :return:
+        :raise ValueError: The download integrity could not be validated
+        """
+        handler = self.handler
+        loop = asyncio.get_event_loop()
+        writer = updater.stream.VerifiedWriter(path, entry["codec"], entry["hash"], handler.get_hash_algorithm())
+        exclude = entry.setdefault("failed_hosts", [])
+        tasks = collections.deque()
+        try:
+            if await loop.run_in_executor(None, writer.resume):
+                handler.log.info("Resuming {0} from byte {1}".format(path, writer.received))
+            try:
+                data, status, headers = await self.__fetch(
+                    entry["source"], handler._first_range(writer, entry.get("csize")), writer, exclude=exclude)
+            except urllib.error.HTTPError as e:
+                if not handler._range_satisfied(e, writer):
+                    raise
+                status, headers = e.code, e.headers
+            rest, segments = handler._plan_rest(writer, status, headers)
+            if rest:
+                await self.__fetch(entry["source"], rest, writer, partial=True, exclude=exclude)
+            for start, end in segments:
+                # Write out our own oldest segment rather than wait for a slot while holding some
+                while tasks and self.segment_slots.locked():
+                    await self.__write_segment(writer, tasks.popleft())
+                await self.segment_slots.acquire()
+                tasks.append(asyncio.ensure_future(self.__fetch_segment(entry["source"], start, end)))
+            while tasks:
+                await self.__write_segment(writer, tasks.popleft())
+            await loop.run_in_executor(None, writer.commit)
+        except ValueError:
+            self.__cancel_segments(tasks)
+            writer.abort()
+            raise
+        except:
+            self.__cancel_segments(tasks)
+            writer.close()
+            raise
+
+    def __cancel_segments(self, tasks):
+        """ Cancel the segments a failed download was still fetching and free their slots.
+
+        :param tasks: The tasks fetching the segments
+        :return:
+        """
+        for task in tasks:
+            task.cancel()
+            self.segment_slots.release()
+
+    async def __write_segment(self, writer, task):
+        """ Wait for a segment to arrive, free its slot, and write it out.
+
+        :param updater.stream.VerifiedWriter writer: The file being downloaded
+        :param task: The task fetching the segment
+        :return:
+        """
+        try:
+            data = await task
+        finally:
+            self.segment_slots.release()
+        await asyncio.get_event_loop().run_in_executor(None, writer.write, data)
+
+    async def __download_bundle(self, bundle):
+        """ Download the members of a bundle which need updating with a single request.
+
+        :param dict bundle: The bundle task built by HashHandler
+        :return:
+        """
+        handler = self.handler
+        members, start, end = handler._bundle_range(bundle)
+        try:
+            data, status, headers = await self.__fetch(bundle["source"], {"Range": "bytes={0}-{1}".format(start, end)})
+        except:
+            handler._bundle_failed(bundle, members)
+            return
+        await asyncio.get_event_loop().run_in_executor(None, handler._extract_bundle, members, data,
+                                                       start if status == 206 else 0, self.destination)
@@ -14,11 +14,22 @@ class ConfigHandler:
 
     __hash_addresses = {
         "master": [
-            "http://odin.nordinvasion.com/mod/master.json",
-            "http://thor.nordinvasion.com/mod/master.json"
+            "http://odin.nordinvasion.com/mod/master.pack",
+            "http://thor.nordinvasion.com/mod/master.pack"
         ]
     }
     __max_download_attempts = 3
+    __request_timeout = 30
+    __cache_dir = ".updater"
+    __adaptive_concurrency = True
+    __download_engine = "threads"
+    __download_threads = 16
+    __download_transfers = 64
+    __download_segment_size = 8 * 1024 * 1024
+    __download_segment_threshold = 16 * 1024 * 1024
+    __pipelined_update = True
+    __validate_backend = "threads"
+    __validate_threads = 16
     __self_update_address = "https://nordinvasion.com/ajax/updater-version.ajax.php"
 
     __display_channel_menu = False
@@ -33,6 +44,8 @@ class ConfigHandler:
         ("Program Files\Warband", "Program Files\\Mount&Blade Warband\\Modules"),
     ]
 
+    __default_bandwidth_limit = 0
+    __default_deep_verify = 0
     __default_logging_level = 10
 
     def __init__(self, cfg_path):
@@ -55,9 +68,27 @@ class ConfigHandler:
         with open(self.__cfg_path, "w") as configfile:
             self.__cfg.write(configfile)
 
+    def adaptive_concurrency(self):
+        return bool(self.__adaptive_concurrency)
+
     def auth_server(self):
         return str(self.__auth_server)
 
+    def bandwidth_limit(self, *, default=None, set_value=None):
+        """The download bandwidth cap in KiB/s, or 0 for no cap"""
+        if set_value is not None:
+            self.__set("General", "bandwidth_limit", str(set_value))
+        return int(self.__get("General", "bandwidth_limit", default if default else self.__default_bandwidth_limit))
+
+    def cache_dir(self):
+        return str(self.__cache_dir)
+
+    def deep_verify(self, *, default=None, set_value=None):
+        """Whether to hash every file when validating, ignoring the local hash index"""
+        if set_value is not None:
+            self.__set("General", "deep_verify", str(int(set_value)))
+        return bool(int(self.__get("General", "deep_verify", default if default else self.__default_deep_verify)))
+
     def default_channel(self):
         return str(self.__default_channel)
 
@@ -67,6 +98,21 @@ class ConfigHandler:
     def display_debug_menu(self):
         return bool(self.__display_debug_menu)
 
+    def download_engine(self):
+        return str(self.__download_engine)
+
+    def download_threads(self):
+        return int(self.__download_threads)
+
+    def download_transfers(self):
+        return int(self.__download_transfers)
+
+    def download_segment_size(self):
+        return int(self.__download_segment_size)
+
+    def download_segment_threshold(self):
+        return int(self.__download_segment_threshold)
+
     def drive_letters(self):
         return list(self.__drive_letters)
 
@@ -100,9 +146,15 @@ class ConfigHandler:
     def modules_dir_common(self):
         return list(self.__modules_dir_common)
 
+    def pipelined_update(self):
+        return bool(self.__pipelined_update)
+
     def publisher(self):
         return str(self.__publisher)
 
+    def request_timeout(self):
+        return int(self.__request_timeout)
+
     def self_update_address(self):
         return str(self.__self_update_address)
 
@@ -111,3 +163,9 @@ class ConfigHandler:
 
     def url(self):
         return str(self.__url)
+
+    def validate_backend(self):
+        return str(self.__validate_backend)
+
+    def validate_threads(self):
+        return int(self.__validate_threads)
@@ -0,0 +1,173 @@
+import bz2
+import hashlib
+import lzma
+import time
+import zlib
+
+DEFAULT_CODEC = "gzip"
+SAMPLE_SIZE = 1024 * 1024
+
+
+class _StoreCompressor:
+
+    @staticmethod
+    def compress(data):
+        return data
+
+    @staticmethod
+    def flush():
+        return b""
+
+
+class _StoreDecompressor:
+
+    eof = False
+    unused_data = b""
+
+    @staticmethod
+    def decompress(data):
+        return data
+
+
+# Codec name: (file extension, compressor factory, decompressor factory)
+# zlib's gzip wrapper leaves the name and timestamp out of the header, so identical files compress identically
+CODECS = {
+    "store": ("", _StoreCompressor, _StoreDecompressor),
+    "gzip": (".gz", lambda: zlib.compressobj(9, zlib.DEFLATED, 31), lambda: zlib.decompressobj(15+32)),
+    "bz2": (".bz2", lambda: bz2.BZ2Compressor(9), bz2.BZ2Decompressor),
+    "lzma": (".xz", lambda: lzma.LZMACompressor(preset=6), lzma.LZMADecompressor),
+}
+CODEC_ORDER = ["store", "gzip", "bz2", "lzma"]
+# Reference decode speeds of a modest client in bytes per second, so the auto codec only depends on a file's content
+DECODE_SPEEDS = {
+    "store": 1024 * 1024 * 1024,
+    "gzip": 128 * 1024 * 1024,
+    "bz2": 16 * 1024 * 1024,
+    "lzma": 24 * 1024 * 1024,
+}
+
+
+class StreamDecompressor:
+
+    def __init__(self, codec):
+        """ Decompress data as it arrives, which may be made up of several concatenated members.
+
+        :param str codec: The codec name
+        """
+        self.codec = codec
+        self.decompressor = get_decompressor(codec)
+        self.started = False
+
+    def decompress(self, data):
+        """ Decompress the next piece of the data.
+
+        :param bytes data: The next piece of the compressed data
+        :return bytes: Whatever could be decompressed so far
+        """
+        output = []
+        while data:
+            if self.decompressor.eof:
+                self.decompressor = get_decompressor(self.codec)
+            self.started = True
+            output.append(self.decompressor.decompress(data))
+            data = self.decompressor.unused_data if self.decompressor.eof else b""
+        return b"".join(output)
+
+    def check_complete(self):
+        """ Check that the data did not stop part way through a member.
+
+        :raise ValueError: The data was truncated
+        """
+        if self.codec != "store" and self.started and not self.decompressor.eof:
+            raise ValueError("Truncated " + self.codec + " stream")
+
+
+def compress(codec, data):
+    """ Compress data in one go.
+
+    :param str codec: The codec name
+    :param bytes data: The data to compress
+    :return bytes: The compressed data
+    """
+    compressor = get_compressor(codec)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(codec, data):
+    """ Decompress data which may be made up of several concatenated members.
+
+    :param str codec: The codec name
+    :param bytes data: The compressed data
+    :return bytes: The decompressed data
+    """
+    output = []
+    while data:
+        decompressor = get_decompressor(codec)
+        output.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    return b"".join(output)
+
+
+def get_compressor(codec):
+    """ Return a new streaming compressor with compress() and flush() methods.
+
+    :param str codec: The codec name
+    """
+    return CODECS[codec][1]()
+
+
+def get_decompressor(codec):
+    """ Return a new streaming decompressor with decompress() and unused_data.
+
+    :param str codec: The codec name
+    """
+    return CODECS[codec][2]()
+
+
+def get_extension(codec):
+    """ Return the file extension used for a codec.
+
+    :param str codec: The codec name
+    :return str: The extension, including its dot
+    """
+    return CODECS[codec][0]
+
+
+def measure_decode_speeds(sample_size=SAMPLE_SIZE):
+    """ Measure how many bytes per second each codec decodes on this machine, to compare against DECODE_SPEEDS.
+
+    The sample is generated rather than random so every run measures the same data.
+
+    :param int sample_size: The amount of data to decode
+    :return dict: Codec name to bytes per second
+    """
+    sample = b"".join(hashlib.sha1(str(i).encode()).hexdigest().encode() for i in range(sample_size // 40))
+    speeds = {}
+    for codec in CODEC_ORDER:
+        compressed = compress(codec, sample)
+        start = time.perf_counter()
+        decompress(codec, compressed)
+        speeds[codec] = len(sample) / max(time.perf_counter() - start, 1e-6)
+    return speeds
+
+
+def select_codec(sample, *, bandwidth, decode_speeds=None):
+    """ Pick the codec which gets a file onto a client's disk the fastest.
+
+    The cost of each codec is the time to download the sample compressed with it plus the time to decode it.  With the
+    reference decode speeds the choice only depends on the sample, so packaging the same file always picks the same
+    codec.
+
+    :param bytes sample: The start of the file
+    :param dict decode_speeds: Codec name to bytes per second, DECODE_SPEEDS by default
+    :param float bandwidth: The client's download speed in bytes per second
+    :return str: The codec name
+    """
+    decode_speeds = decode_speeds or DECODE_SPEEDS
+    best_codec = DEFAULT_CODEC
+    best_cost = None
+    for codec in CODEC_ORDER:
+        cost = len(compress(codec, sample)) / bandwidth + len(sample) / decode_speeds[codec]
+        if best_cost is None or cost < best_cost:
+            best_codec, best_cost = codec, cost
+    return best_codec
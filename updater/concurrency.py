@@ -0,0 +1,214 @@
+import os
+import threading
+import time
+
+
+class ConcurrencyController:
+
+    minimum = 1
+    maximum = 8
+    initial = 2
+    interval = 1.0
+    decrease_factor = 0.5
+    error_threshold = 0.1
+    latency_tolerance = None
+    throughput_tolerance = 0.2
+
+    def __init__(self, maximum=None, initial=None, adaptive=True):
+        """ Limit how many workers run at once, tuning the limit from what the workers report.
+
+        The limit doubles each interval while every allowed worker is busy, until the first sign of congestion, and from
+        then on grows by one instead.  It is halved whenever an interval shows congestion: too many errors, latency well
+        above the best seen, or a drop in throughput right after the limit was raised.  Subclasses set the policy for a
+        kind of work through the class attributes.
+
+        :param int maximum: The most workers to ever allow
+        :param int initial: The number of workers to start with
+        :param bool adaptive: Whether to tune the limit, or keep it at the maximum
+        """
+        if maximum:
+            self.maximum = max(maximum, self.minimum)
+        if not adaptive:
+            self.minimum = self.initial = self.maximum
+        elif initial:
+            self.initial = initial
+        self.adaptive = adaptive
+        self.limit = min(max(self.initial, self.minimum), self.maximum)
+        self.condition = threading.Condition()
+        self.active = 0
+        self.base_latency = None
+        self.previous_throughput = None
+        self.last_change = 0
+        self.slow_start = True
+        self.__reset_window(time.monotonic())
+
+    def acquire(self):
+        """ Wait until another worker is allowed to run.
+
+        :return:
+        """
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.__start_worker()
+
+    def release(self):
+        """ Mark a worker as finished.
+
+        :return:
+        """
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def record(self, size, latency, ok=True):
+        """ Report a finished piece of work, adjusting the limit at the end of each interval.
+
+        :param int size: The number of bytes the work moved
+        :param float latency: How long the work took to respond
+        :param bool ok: Whether the work succeeded
+        :return:
+        """
+        with self.condition:
+            self.window_count += 1
+            self.window_bytes += size
+            if ok:
+                self.window_latency += latency
+            else:
+                self.window_errors += 1
+            now = time.monotonic()
+            if self.adaptive and now - self.window_start >= self.interval:
+                self.__adjust(now)
+
+    def __start_worker(self):
+        self.active += 1
+        self.window_peak = max(self.window_peak, self.active)
+
+    def __adjust(self, now):
+        """ Apply the policy to the interval which just ended. """
+        throughput = self.window_bytes / (now - self.window_start)
+        successes = self.window_count - self.window_errors
+        congested = self.window_errors > self.error_threshold * self.window_count
+        if self.latency_tolerance and successes:
+            latency = self.window_latency / successes
+            if self.base_latency is None or latency < self.base_latency:
+                self.base_latency = latency
+            elif latency > self.base_latency * self.latency_tolerance:
+                congested = True
+        if self.last_change > 0 and self.previous_throughput and \
+                throughput < self.previous_throughput * (1 - self.throughput_tolerance):
+            # The last increase made things worse
+            congested = True
+        previous_limit = self.limit
+        if congested:
+            self.slow_start = False
+            self.limit = max(self.minimum, int(self.limit * self.decrease_factor))
+        elif self.window_peak >= self.limit:
+            self.limit = min(self.maximum, self.limit * 2 if self.slow_start else self.limit + 1)
+        self.last_change = self.limit - previous_limit
+        self.previous_throughput = throughput
+        if self.last_change > 0:
+            self.condition.notify_all()
+        self.__reset_window(now)
+
+    def __reset_window(self, now):
+        self.window_start = now
+        self.window_count = 0
+        self.window_bytes = 0
+        self.window_errors = 0
+        self.window_latency = 0.0
+        self.window_peak = self.active
+
+
+class DownloadConcurrency(ConcurrencyController):
+
+    # Network transfers back off on errors and when the time to first byte climbs, which means queueing somewhere
+    maximum = 32
+    initial = 2
+    latency_tolerance = 3.0
+
+
+class ValidationConcurrency(ConcurrencyController):
+
+    # Hashing is bound by the disk and CPU, so only throughput counts.  A spinning disk gets slower when it has to
+    # seek between too many files, which shows up as a drop after an increase.
+    maximum = max(2, (os.cpu_count() or 1) * 2)
+    initial = 2
+    interval = 0.5
+
+
+class StallDetector:
+
+    def __init__(self, min_throughput, window):
+        """ Spot a transfer which has slowed to a trickle.
+
+        :param float min_throughput: The slowest acceptable bytes per second
+        :param float window: How many seconds to average the throughput over
+        """
+        self.min_throughput = min_throughput
+        self.window = window
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+
+    def update(self, size):
+        """ Count some received bytes.
+
+        :param int size: The number of bytes received
+        :return bool: True if the last window was below the minimum throughput
+        """
+        self.window_bytes += size
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed < self.window:
+            return False
+        stalled = self.window_bytes / elapsed < self.min_throughput
+        self.window_start = now
+        self.window_bytes = 0
+        return stalled
+
+    def pause(self, seconds):
+        """ Leave out time spent waiting on purpose, such as for the bandwidth cap.
+
+        :param float seconds: The time to leave out
+        :return:
+        """
+        self.window_start += seconds
+
+
+class RateLimiter:
+
+    def __init__(self, rate, burst=None):
+        """ Cap the combined bandwidth of every download with a token bucket.
+
+        :param float rate: The most bytes per second to allow
+        :param float burst: The most bytes to allow at once after an idle spell, one second's worth by default
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, size):
+        """ Take some bytes out of the budget.
+
+        :param int size: The number of bytes about to be used
+        :return float: How many seconds to wait before using them
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= size
+            return max(0.0, -self.tokens / self.rate)
+
+    def consume(self, size):
+        """ Take some bytes out of the budget, sleeping until they are allowed.
+
+        :param int size: The number of bytes about to be used
+        :return float: How many seconds it slept
+        """
+        delay = self.reserve(size)
+        if delay:
+            time.sleep(delay)
+        return delay
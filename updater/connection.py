@@ -0,0 +1,323 @@
+import certifi
+import http.client
+import io
+import socket
+import ssl
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class ConnectionPool:
+
+    max_idle = 8
+    max_redirects = 5
+
+    def __init__(self, ssl_context=None):
+        """ Keep HTTP connections open between requests so each host only pays for its handshakes once.
+
+        Connections are kept per scheme, host and port, and can be shared by any number of threads.  Each host name is
+        only resolved once for the life of the pool, and every address it resolves to is tried in turn.  Requests to a
+        host behind a configured proxy go through urllib instead, which honours the proxy settings.
+
+        :param ssl_context: The SSL context to use for https connections
+        """
+        if not ssl_context:
+            ssl_context = ssl.create_default_context()
+            ssl_context.load_verify_locations(certifi.where())
+        self.ssl_context = ssl_context
+        self.proxies = urllib.request.getproxies()
+        self.opener = urllib.request.build_opener(urllib.request.ProxyHandler(self.proxies),
+                                                  urllib.request.HTTPSHandler(context=ssl_context))
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.addresses = {}
+        self.counters = {"requests": 0, "reused": 0, "opened": 0, "dns_hits": 0, "dns_misses": 0}
+
+    def urlopen(self, request, data=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        """ Send a request on a pooled connection, following redirects.
+
+        This behaves like urllib.request.urlopen: a response outside of the 2xx range raises HTTPError.  The connection
+        goes back to the pool once the response has been read to the end and closed.
+
+        :param request: A urllib.request.Request or a URL
+        :param bytes data: The request body, overriding the request's own
+        :param float timeout: The socket timeout in seconds
+        :return PooledResponse: The response, or urllib's own response if the request went through a proxy
+        :raise urllib.error.HTTPError: The server answered with an error
+        :raise urllib.error.URLError: The server could not be reached
+        """
+        if not isinstance(request, urllib.request.Request):
+            request = urllib.request.Request(request)
+        if data is not None:
+            request.data = data
+        if self.uses_proxy(request.full_url):
+            return self.opener.open(request, timeout=timeout)
+        url = request.full_url
+        method = request.get_method()
+        body = request.data
+        headers = dict(request.header_items())
+        for redirect in range(self.max_redirects + 1):
+            response = self.__send(method, url, body, headers, timeout)
+            if response.status not in REDIRECT_CODES or not response.headers.get("Location"):
+                break
+            response.read()
+            response.close()
+            url = urllib.parse.urljoin(url, response.headers["Location"])
+            if response.status == 303 or (response.status in (301, 302) and method == "POST"):
+                method, body = "GET", None
+                headers.pop("Content-Type", None)
+        if not 200 <= response.status < 300:
+            # Read the body now so the connection can go back to the pool
+            error_body = response.read()
+            response.close()
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers,
+                                         io.BytesIO(error_body))
+        return response
+
+    def uses_proxy(self, url):
+        """ Check whether requests to a URL have to go through a proxy.
+
+        :param str url: The URL
+        :return bool:
+        """
+        parts = urllib.parse.urlsplit(url)
+        return uses_proxy(self.proxies, parts.scheme, parts.hostname)
+
+    def stats(self):
+        """ Report how often a connection or an address could be reused.
+
+        :return dict: The request, connection and DNS counters, plus the connection and DNS hit rates
+        """
+        with self.lock:
+            return hit_rates(self.counters)
+
+    def close(self):
+        """ Close every idle connection.
+
+        :return:
+        """
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def release(self, key, connection, reusable):
+        """ Return a connection to the pool, or close it if it can't carry another request.
+
+        :param tuple key: The scheme, host and port the connection belongs to
+        :param connection: The connection
+        :param bool reusable: Whether the last response was read to the end on a connection which stays open
+        :return:
+        """
+        if reusable:
+            with self.lock:
+                connections = self.idle.setdefault(key, [])
+                if len(connections) < self.max_idle:
+                    connections.append(connection)
+                    return
+        connection.close()
+
+    def __send(self, method, url, body, headers, timeout):
+        """ Send one request, moving to a fresh connection if a pooled one turns out to have been closed. """
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise urllib.error.URLError("Unsupported scheme: " + parts.scheme)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        headers = dict(headers)
+        headers.setdefault("Host", parts.netloc)
+        headers.setdefault("User-Agent", "Python-urllib")
+        with self.lock:
+            self.counters["requests"] += 1
+        while True:
+            connection, reused = self.__acquire(key, timeout)
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError,
+                    http.client.BadStatusLine) as e:
+                connection.close()
+                if reused:
+                    # The server dropped the idle connection, so the request never reached it
+                    continue
+                raise urllib.error.URLError(e)
+            except OSError as e:
+                connection.close()
+                raise urllib.error.URLError(e)
+            if reused:
+                with self.lock:
+                    self.counters["reused"] += 1
+            return PooledResponse(self, key, connection, response, url)
+
+    def __acquire(self, key, timeout):
+        """ Take an idle connection for a host, or open a new one.
+
+        :return tuple: The connection and whether it was reused
+        """
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                connection = connections.pop()
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(None if timeout is socket._GLOBAL_DEFAULT_TIMEOUT else timeout)
+                return connection, True
+            self.counters["opened"] += 1
+        scheme, host, port = key
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(host, port, timeout=timeout, context=self.ssl_context)
+        else:
+            connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        # Connect to the cached addresses, while TLS still checks the certificate against the host name
+        connection._create_connection = lambda address, *args: self.__connect(host, port, *args)
+        return connection, False
+
+    def __connect(self, host, port, *args):
+        """ Connect to each of a host's addresses in turn until one answers.
+
+        An address which answers is moved to the front, so later connections try it first.
+
+        :return socket.socket: The connected socket
+        :raise OSError: The error from the last address, if none of them answered
+        """
+        addresses = self.__resolve(host, port)
+        error = None
+        for address in addresses:
+            try:
+                sock = socket.create_connection((address, port), *args)
+            except OSError as e:
+                error = e
+                continue
+            if address != addresses[0]:
+                with self.lock:
+                    self.addresses[(host, port)] = [address] + [other for other in addresses if other != address]
+            return sock
+        raise error
+
+    def __resolve(self, host, port):
+        """ Resolve a host name once per session.
+
+        :return list: The addresses to connect to, in the order to try them
+        """
+        with self.lock:
+            addresses = self.addresses.get((host, port))
+            if addresses:
+                self.counters["dns_hits"] += 1
+                return addresses
+            self.counters["dns_misses"] += 1
+        addresses = unique_addresses(socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM))
+        with self.lock:
+            self.addresses[(host, port)] = addresses
+        return addresses
+
+
+def unique_addresses(info):
+    """ List the addresses from a getaddrinfo result once each, keeping their order.
+
+    :param list info: The getaddrinfo result
+    :return list: The addresses
+    """
+    addresses = []
+    for family, kind, protocol, name, address in info:
+        if address[0] not in addresses:
+            addresses.append(address[0])
+    return addresses
+
+
+def uses_proxy(proxies, scheme, host):
+    """ Check whether requests for a scheme and host have to go through one of the configured proxies.
+
+    :param dict proxies: The proxies, as returned by urllib.request.getproxies
+    :param str scheme: The URL scheme
+    :param str host: The host name
+    :return bool:
+    """
+    return scheme in proxies and not urllib.request.proxy_bypass(host)
+
+
+def hit_rates(counters):
+    """ Add the connection and DNS hit rates to a copy of a pool's counters.
+
+    :param dict counters: The request, connection and DNS counters
+    :return dict:
+    """
+    stats = dict(counters)
+    stats["connection_hit_rate"] = stats["reused"] / stats["requests"] if stats["requests"] else 0.0
+    lookups = stats["dns_hits"] + stats["dns_misses"]
+    stats["dns_hit_rate"] = stats["dns_hits"] / lookups if lookups else 0.0
+    return stats
+
+
+class PooledResponse(io.RawIOBase):
+
+    def __init__(self, pool, key, connection, response, url):
+        """ A response which hands its connection back to the pool when it is closed.
+
+        :param ConnectionPool pool: The pool the connection came from
+        :param tuple key: The scheme, host and port of the connection
+        :param connection: The connection
+        :param http.client.HTTPResponse response: The response
+        :param str url: The URL which was requested
+        """
+        super().__init__()
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def readable(self):
+        return True
+
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        if not data and amt != 0:
+            self.__check_complete()
+        return data
+
+    def read1(self, amt=-1):
+        """ Read whatever has arrived, up to amt bytes, waiting only if nothing has. """
+        data = self.response.read1(amt)
+        if not data and amt != 0:
+            self.__check_complete()
+        return data
+
+    def readinto(self, buffer):
+        count = self.response.readinto(buffer)
+        if not count and len(buffer):
+            self.__check_complete()
+        return count
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+    def __check_complete(self):
+        """ Raise if the connection closed before the whole body arrived, which http.client only notices for read(). """
+        if self.response.length:
+            raise http.client.IncompleteRead(b"", self.response.length)
+
+    def close(self):
+        if self.connection is not None:
+            # The response closes itself once its body has been read to the end
+            reusable = self.response.isclosed() and not self.response.will_close
+            if not reusable:
+                self.response.close()
+            self.pool.release(self.key, self.connection, reusable)
+            self.connection = None
+        super().close()
@@ -0,0 +1,129 @@
+import hashlib
+import struct
+
+MAGIC = b"NID1"
+BLOCK_SIZE = 4096
+RESYNC_BLOCKS = 8
+RESYNC_WINDOW = 1024 * 1024
+# How many target blocks to try before deciding the files are unrelated
+PROBE_BLOCKS = 64
+
+OP_COPY = 1
+OP_ADD = 2
+
+_copy_struct = struct.Struct("<BQI")
+_add_struct = struct.Struct("<BI")
+
+
+def create_delta(base, target, block_size=BLOCK_SIZE, probe_blocks=PROBE_BLOCKS):
+    """ Create a binary delta which rebuilds the target from the base.
+
+    Blocks of the target are matched against the base, first at the position following the previous match and then
+    against an index of the base's aligned blocks.  When neither matches, the next few base blocks are searched for in
+    the target so that insertions and deletions resynchronise without a byte-by-byte scan.  Those searches make
+    unrelated files slow to compare, so if none of the first few blocks match the files are taken to be unrelated.
+
+    :param bytes base: The old version of the file
+    :param bytes target: The new version of the file
+    :param int block_size: The size of the blocks to match
+    :param int probe_blocks: How many unmatched blocks to try before giving up, or 0 to never give up
+    :return bytes: The delta, or None if the files look unrelated
+    """
+    index = {}
+    for offset in range(0, len(base) - block_size + 1, block_size):
+        index.setdefault(hashlib.md5(base[offset:offset + block_size]).digest(), offset)
+    ops = []
+    position = 0
+    literal_start = 0
+    expected = 0
+    probed = 0
+    while position + block_size <= len(target):
+        if not ops and probe_blocks and probed >= probe_blocks:
+            return None
+        probed += 1
+        block = target[position:position + block_size]
+        match = None
+        if base[expected:expected + block_size] == block:
+            match = expected
+        else:
+            candidate = index.get(hashlib.md5(block).digest())
+            if candidate is not None and base[candidate:candidate + block_size] == block:
+                match = candidate
+        if match is not None:
+            if literal_start < position:
+                ops.append((OP_ADD, literal_start, position - literal_start))
+            _append_copy(ops, match, block_size)
+            position += block_size
+            literal_start = position
+            expected = match + block_size
+            continue
+        # Look for one of the upcoming base blocks further along the target
+        aligned = -(-expected // block_size) * block_size
+        resync = None
+        for offset in range(aligned, min(aligned + RESYNC_BLOCKS * block_size, len(base)), block_size):
+            found = target.find(base[offset:offset + block_size], position + 1, position + RESYNC_WINDOW)
+            if found != -1 and (resync is None or found < resync[0]):
+                resync = (found, offset)
+        if resync:
+            position, expected = resync
+        else:
+            position += block_size
+            expected += block_size
+    # Whatever is left is either the end of the base or new data
+    tail = target[position:]
+    if literal_start == position and tail and base[expected:expected + len(tail)] == tail:
+        _append_copy(ops, expected, len(tail))
+    elif literal_start < len(target):
+        ops.append((OP_ADD, literal_start, len(target) - literal_start))
+    # Serialize the operations
+    output = [MAGIC]
+    for op, start, length in ops:
+        if op == OP_COPY:
+            output.append(_copy_struct.pack(OP_COPY, start, length))
+        else:
+            output.append(_add_struct.pack(OP_ADD, length))
+            output.append(target[start:start + length])
+    return b"".join(output)
+
+
+def apply_delta(base_file, delta, output_file, chunk_size=1024 * 1024):
+    """ Rebuild a file from its base and a delta.
+
+    :param base_file: A seekable binary file object holding the base
+    :param bytes delta: The delta created by create_delta
+    :param output_file: A binary file object to write the result to
+    :param int chunk_size: The largest amount of the base to hold in memory at once
+    :raise ValueError: The delta is malformed
+    """
+    if not delta.startswith(MAGIC):
+        raise ValueError("Not a delta")
+    position = len(MAGIC)
+    while position < len(delta):
+        op = delta[position]
+        if op == OP_COPY:
+            op, offset, length = _copy_struct.unpack_from(delta, position)
+            position += _copy_struct.size
+            base_file.seek(offset)
+            while length > 0:
+                data = base_file.read(min(length, chunk_size))
+                if not data:
+                    raise ValueError("Delta copies past the end of the base")
+                output_file.write(data)
+                length -= len(data)
+        elif op == OP_ADD:
+            op, length = _add_struct.unpack_from(delta, position)
+            position += _add_struct.size
+            if position + length > len(delta):
+                raise ValueError("Truncated delta")
+            output_file.write(delta[position:position + length])
+            position += length
+        else:
+            raise ValueError("Unknown delta operation " + str(op))
+
+
+def _append_copy(ops, offset, length):
+    """ Append a copy operation, merging it into the previous one when they are contiguous. """
+    if ops and ops[-1][0] == OP_COPY and ops[-1][1] + ops[-1][2] == offset:
+        ops[-1] = (OP_COPY, ops[-1][1], ops[-1][2] + length)
+    else:
+        ops.append((OP_COPY, offset, length))
@@ -0,0 +1,86 @@
+import hashlib
+import mmap
+import os
+import time
+
+DEFAULT_ALGORITHM = "sha1"
+BLOCK_SIZE = 1024 * 1024
+
+# Algorithm name: hash object factory taking the initial data
+# Every algorithm gives a 20 byte digest, so hashes look the same in manifests, blob names and delta names
+ALGORITHMS = {
+    "sha1": hashlib.sha1,
+}
+if hasattr(hashlib, "blake2b"):
+    # BLAKE2 needs Python 3.6 or later
+    ALGORITHMS["blake2b"] = lambda data=b"": hashlib.blake2b(data, digest_size=20)
+ALGORITHM_ORDER = [algorithm for algorithm in ["sha1", "blake2b"] if algorithm in ALGORITHMS]
+
+
+def new(algorithm=DEFAULT_ALGORITHM, data=b""):
+    """ Return a new hash object.
+
+    :param str algorithm: The algorithm name
+    :param bytes data: Data to start the hash with
+    :raise ValueError: The algorithm isn't available on this Python
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError("Unsupported hash algorithm " + str(algorithm))
+    return ALGORITHMS[algorithm](data)
+
+
+def get_hash(data, algorithm=DEFAULT_ALGORITHM):
+    """ Return the hex digest of some data.
+
+    :param bytes data: The data to hash
+    :param str algorithm: The algorithm name
+    :return str: The hash
+    """
+    return new(algorithm, data).hexdigest()
+
+
+def hash_file(file_path, algorithm=DEFAULT_ALGORITHM, block_size=BLOCK_SIZE):
+    """ Return the hex digest of a file, a block at a time so memory use stays the same whatever the file's size.
+
+    Files larger than a block are mapped rather than read, which saves copying each block out of the page cache.  This
+    is a module level function so it can run in a process pool.
+
+    :param str file_path: The file to hash
+    :param str algorithm: The algorithm name
+    :param int block_size: How much of the file to hash at a time
+    :return str: The hash
+    """
+    file_hash = new(algorithm)
+    with open(file_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size > block_size:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, size, block_size):
+                        file_hash.update(view[offset:offset + block_size])
+                finally:
+                    # The map can't be closed while a view of it is still open
+                    view.release()
+        else:
+            file_hash.update(file.read())
+    return file_hash.hexdigest()
+
+
+def measure_hash_speeds(sample_size=64 * 1024 * 1024, block_size=BLOCK_SIZE):
+    """ Measure how many bytes per second each algorithm hashes on this machine.
+
+    :param int sample_size: The amount of data to hash
+    :param int block_size: How much data to hash at a time, as validation does
+    :return dict: Algorithm name to bytes per second
+    """
+    block = os.urandom(block_size)
+    speeds = {}
+    for algorithm in ALGORITHM_ORDER:
+        file_hash = new(algorithm)
+        start = time.perf_counter()
+        for i in range(max(1, sample_size // block_size)):
+            file_hash.update(block)
+        file_hash.hexdigest()
+        speeds[algorithm] = max(1, sample_size // block_size) * block_size / max(time.perf_counter() - start, 1e-6)
+    return speeds
@@ -1,28 +1,88 @@
 import certifi
+import collections
+import concurrent.futures
 import hashlib
 import json
 import time
 import os.path
 import queue
+import random
 import ssl
 import threading
 import urllib.error
 import urllib.parse
 import urllib.request
-import zlib
+import updater.aio
+import updater.codec
+import updater.concurrency
+import updater.connection
+import updater.delta
+import updater.digest
+import updater.manifest
+import updater.mirror
+import updater.stream
 
 
 class HashHandler:
 
+    block_size = 64 * 1024
+    hash_block_size = updater.digest.BLOCK_SIZE
+    resume_min_size = 1024 * 1024
+    bundle_min_members = 2
+    hash_deadline = 10
+    hash_grace = 0.5
+    hedge_budget = 0.05
+    hedge_min_delay = 0.5
+    hedge_min_samples = 20
+    hedge_percentile = 0.95
+    mirror_smoothing = 0.3
+    request_timeout = 30
+    retry_backoff = 0.5
+    retry_backoff_max = 30
+    retry_window = 120
+    segment_size = 8 * 1024 * 1024
+    segment_threshold = 16 * 1024 * 1024
+    segment_threads = 4
+    stall_throughput = 4 * 1024
+    stall_window = 10
     hash_dict = None
     hash_addresses = None
+    hash_mirrors = []
+    mirrors = None
+    rate_limiter = None
+    download_concurrency = None
+    validate_concurrency = None
+    segment_executor = None
+    hash_executor = None
+    request_executor = None
+    response_latencies = None
+    requests_sent = 0
+    hedges_sent = 0
+    async_engine = None
+    async_pool = None
+    deep_verify = False
+    pipelined = False
+    bundle_members = None
     downloads_failed_list = []
     downloads_total_counter = 0
     downloads_completed_counter = 0
+    validations_total_counter = 0
+    validations_completed_counter = 0
 
-    def __init__(self, *, addresses, max_attempts, logging):
+    def __init__(self, *, addresses, max_attempts, logging, cache_dir=None, segment_size=None, segment_threshold=None,
+                 pool=None, bandwidth_limit=None, request_timeout=None):
         self.log = logging
         self.hash_addresses = addresses
+        self.cache_dir = cache_dir
+        if segment_size:
+            self.segment_size = segment_size
+        if segment_threshold:
+            self.segment_threshold = segment_threshold
+        if request_timeout:
+            self.request_timeout = request_timeout
+        if bandwidth_limit:
+            # Every download shares the one budget
+            self.rate_limiter = updater.concurrency.RateLimiter(bandwidth_limit)
         self.download_queue = queue.Queue()
         self.validate_queue = queue.Queue()
 
@@ -33,19 +93,29 @@ class HashHandler:
 
         self.ssl_context = ssl.create_default_context()
         self.ssl_context.load_verify_locations(certifi.where())
+        self.pool = pool or updater.connection.ConnectionPool(self.ssl_context)
 
-    def build_validate_queue(self, path=None, hash_dict=None):
+        self.installed_dirs = self.__load_state("installed.json").get("dirs", {})
+        # The hash of each local file as of its size, modification time and inode when it was last hashed or written
+        self.file_index = self.__load_state("file_index.json")
+
+    def build_validate_queue(self, path=None, hash_dict=None, deep=False):
         """ Build the validate queue from a hash dictionary.
 
         Loop through a hash dictionary to create one entry for each file that needs to be validated.
         If the dictionary entry is a file, generate extra information and store it in the queue entry.
         If the dictionary entry is a directory, pass it back into this function to process its entries.
+        Directories whose hash matches the one recorded after the last successful install are skipped entirely, unless
+        this is a deep verify.
 
         :param dict hash_dict: The dictionary to parse
         :param list path: The path of the files in this dictionary
+        :param bool deep: Whether to queue every file, even in directories which are unchanged since the last install
         """
         if not path:
             path = []
+            if not deep and self.__is_installed(path):
+                return
         if not hash_dict:
             hash_dict = self.hash_dict["files"]
         for key in hash_dict:
@@ -54,56 +124,114 @@ class HashHandler:
                 hash_dict[key]["attempted"] = 0
                 hash_dict[key]["name"] = key
                 hash_dict[key]["path"] = str.join("/", path)
-                hash_dict[key]["url"] = self.__make_url(self.hash_dict["host"], self.hash_dict["version"],
-                                                        hash_dict[key]["path"], hash_dict[key]["name"] + ".gz")
+                hash_dict[key].setdefault("codec", updater.codec.DEFAULT_CODEC)
+                extension = updater.codec.get_extension(hash_dict[key]["codec"])
+                if "store" in self.hash_dict:
+                    # Content addressed manifests share one blob per unique file across all versions
+                    file_hash = hash_dict[key]["hash"]
+                    hash_dict[key]["source"] = self._make_url(self.hash_dict["store"], file_hash[:2],
+                                                              file_hash + extension)
+                else:
+                    hash_dict[key]["source"] = self._make_url(self.hash_dict["version"], hash_dict[key]["path"],
+                                                              hash_dict[key]["name"] + extension)
+                self.validations_total_counter += 1
                 self.validate_queue.put(hash_dict[key])
             else:
                 # If there is no hash, this is a directory which needs to be processed
                 dir_path = path.copy()
                 dir_path.append(key)
-                self.build_validate_queue(dir_path, hash_dict[key])
+                if not deep and self.__is_installed(dir_path):
+                    continue
+                self.build_validate_queue(dir_path, hash_dict[key], deep)
         return
 
     def download_hash(self):
         """ Download and store the fastest most recent copy of the hash file.
 
-        Download each hash file in the address list.  Time each download to determine the best option.  Pick the fastest
-        download unless it is an older version of the hash file.
+        Download every hash file in the address list at once and time each one, body included.  Pick the fastest
+        download unless it is an older version of the hash file.  Once a usable hash file has arrived, mirrors still
+        running at the deadline are dropped, and once the mirror with the best recorded history has answered the others
+        only get a short grace period.  Until then every mirror is waited for, however slow the link.  Only the
+        header of a compact hash file is read while comparing, and only the chosen file's list of files is parsed.
         """
-        context = ssl.create_default_context()
-        context.load_verify_locations(certifi.where())
-        # Check each address for hash files
-        for address in self.hash_addresses:
-            try:
-                # Download the hash file and record the download time
-                start_time = time.perf_counter()
-                request = urllib.request.urlopen(address, context=context)
-                download_time = time.perf_counter() - start_time
-                # Parse the response into a dictionary
-                text = request.read().decode("utf-8")
-                hash_dict = json.loads(text)
-                # Check if this is the best hash file so far
-                if self.hash_dict is None:
-                    self.hash_dict = hash_dict
-                    continue
-                version_diff = self.__compare_versions(self.hash_dict["version"], hash_dict["version"])
-                if version_diff > 0:
-                    self.log.info("Newer: " + address)
-                    self.hash_dict = hash_dict
-                    continue
-                elif version_diff < 0:
-                    self.log.info("Older: " + address)
-                    continue
-                elif download_time < self.hash_dict["download_time"]:
-                    self.log.info("Faster: " + address)
-                    self.hash_dict = hash_dict
-                    continue
-            except urllib.error.HTTPError:
-                self.log.error("Hash Download Failed", tb=True)
-            except ValueError:
-                self.log.error("Invalid Hash", tb=True)
-            except:
-                self.log.error("Unknown Error", tb=True)
+        health = self.__load_state("mirrors.json")
+        hash_cache = self.__load_state("hash_cache.json")
+        preferred = self.__rank_mirrors(self.hash_addresses, health)[0] if self.hash_addresses else None
+        if preferred not in health:
+            preferred = None
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.hash_addresses)))
+        futures = {executor.submit(self.__fetch_hash, address, hash_cache.get(address)): address
+                   for address in self.hash_addresses}
+        deadline = time.perf_counter() + self.hash_deadline
+        results = []
+        pending = set(futures)
+        # Check each address for hash files as they arrive
+        while pending:
+            # Nothing is dropped for being slow until there is a hash file to fall back on
+            timeout = max(0, deadline - time.perf_counter()) if results else None
+            done, pending = concurrent.futures.wait(pending, timeout=timeout,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                address = futures[future]
+                try:
+                    header, data, download_time, size, validators = future.result()
+                    self.__record_mirror(health, address, download_time, size)
+                    if validators:
+                        hash_cache[address] = validators
+                    algorithm = header.get("hash_algorithm", updater.digest.DEFAULT_ALGORITHM)
+                    if algorithm not in updater.digest.ALGORITHMS:
+                        self.log.error("Unsupported hash algorithm " + str(algorithm) + ": " + address)
+                        continue
+                    results.append((header, data, download_time, address))
+                    if address == preferred:
+                        deadline = min(deadline, time.perf_counter() + self.hash_grace)
+                except urllib.error.HTTPError:
+                    self.__record_mirror(health, address)
+                    self.log.error("Hash Download Failed", tb=True)
+                except ValueError:
+                    self.__record_mirror(health, address)
+                    self.log.error("Invalid Hash", tb=True)
+                except:
+                    self.__record_mirror(health, address)
+                    self.log.error("Unknown Error", tb=True)
+        for future in pending:
+            self.log.warning("Hash download too slow: " + futures[future])
+            self.__record_mirror(health, futures[future])
+        executor.shutdown(wait=False)
+        self.__save_state("mirrors.json", health)
+        self.__save_state("hash_cache.json", hash_cache)
+        # Pick the newest version, then the fastest mirror serving it
+        best = None
+        for result in results:
+            if best is None:
+                best = result
+                continue
+            version_diff = self.__compare_versions(best[0]["version"], result[0]["version"])
+            if version_diff > 0:
+                self.log.info("Newer: " + result[3])
+                best = result
+            elif version_diff < 0:
+                self.log.info("Older: " + result[3])
+            elif result[2] < best[2]:
+                self.log.info("Faster: " + result[3])
+                best = result
+        if best is None:
+            return
+        # Remember every host serving the chosen version, fastest first
+        self.hash_mirrors = []
+        for result in sorted(results, key=lambda result: result[2]):
+            if self.__compare_versions(best[0]["version"], result[0]["version"]) == 0 and \
+                    result[0]["host"] not in self.hash_mirrors:
+                self.hash_mirrors.append(result[0]["host"])
+        try:
+            if isinstance(best[1], bytes):
+                self.hash_dict = updater.manifest.decode(best[1])
+            else:
+                self.hash_dict = best[1]
+        except ValueError:
+            self.log.error("Invalid Hash", tb=True)
         return
 
     def get_downloads_failed_list(self):
@@ -125,6 +253,35 @@ class HashHandler:
     def get_downloads_remaining(self):
         return self.downloads_total_counter - self.downloads_completed_counter
 
+    def get_progress(self):
+        """ Getter for the progress of validating and downloading together.
+
+        Finding a stale file adds one to both the files done and the total, so the fraction done never goes backwards
+        while the total grows.
+
+        :return tuple: The number of validations and downloads finished or given up on, and the number known of
+        """
+        done = self.validations_completed_counter + self.downloads_completed_counter + len(self.downloads_failed_list)
+        return done, self.validations_total_counter + self.downloads_total_counter
+
+    def get_hash_algorithm(self):
+        """ Getter for the algorithm the hash dictionary's hashes were made with.
+
+        :return str:
+        """
+        return self.hash_dict.get("hash_algorithm", updater.digest.DEFAULT_ALGORITHM)
+
+    def get_pool_stats(self):
+        """ Getter for the connection pool's reuse counters.
+
+        :return dict:
+        """
+        if not self.async_pool:
+            return self.pool.stats()
+        stats = self.pool.stats()
+        async_stats = self.async_pool.stats()
+        return updater.connection.hit_rates({key: stats[key] + async_stats[key] for key in self.async_pool.counters})
+
     def get_version(self):
         """ Getter for the version of the hash dictionary.
 
@@ -135,36 +292,150 @@ class HashHandler:
         else:
             return None
 
-    def start_downloading(self, *, callback=None, destination=None, threads=1, wait=False):
-        """ Spawn file download processing threads.
+    def record_installed(self):
+        """ Remember the directory hashes of the installed version.
 
-        :param int threads: The number of concurrent threads to spawn
+        Directories holding a file which failed to download are left out, so they are validated again next time.
+        :return:
+        """
+        failed_dirs = set()
+        for entry in self.downloads_failed_list:
+            path = entry["path"].split("/") if entry["path"] else []
+            for i in range(len(path) + 1):
+                failed_dirs.add(str.join("/", path[:i]))
+        dirs = self.hash_dict.get("dirs", {})
+        self.installed_dirs = {key: dirs[key] for key in dirs if key not in failed_dirs}
+        self.__save_state("installed.json", {"dirs": self.installed_dirs})
+        return
+
+    def save_file_index(self):
+        """ Save the hash of each local file, so the next validation only hashes the files which changed.
+
+        :return:
+        """
+        self.__save_state("file_index.json", dict(self.file_index))
+        return
+
+    def start_downloading(self, *, callback=None, destination=None, threads=1, wait=False, engine="threads",
+                          adaptive=False):
+        """ Spawn file download processing threads, or a single thread running the asyncio engine.
+
+        :param int threads: The number of concurrent threads to spawn, or of concurrent transfers for the asyncio engine
         :param callable callback: A callback function to run after each download
         :param bool wait: Determines whether to block this function until the download queue is empty
+        :param str engine: "threads" or "asyncio", which falls back to threads if a mirror is behind a proxy
+        :param bool adaptive: Whether to tune how many of the threads or transfers run at once, up to the number given
         :return:
         """
         self.downloads_failed_list.clear()
-        for i in range(threads):
-            t = threading.Thread(target=self.__download_processor, daemon=True,
-                                 kwargs={"callback": callback, "destination": destination})
-            t.start()
+        # Spread the downloads across every mirror serving this version, starting with the chosen one
+        hosts = [self.hash_dict["host"]] + [host for host in self.hash_mirrors if host != self.hash_dict["host"]]
+        self.mirrors = updater.mirror.MirrorScheduler(hosts)
+        if engine == "asyncio" and any(self.pool.uses_proxy(host) for host in hosts):
+            # The asyncio engine connects to mirrors directly, while the threads go through urllib for proxies
+            self.log.info("A proxy is configured, downloading with threads")
+            engine = "threads"
+        if not self.segment_executor:
+            self.segment_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.segment_threads)
+        if not self.request_executor:
+            # Every download and segment may have a hedged request in flight alongside its own
+            self.request_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=(threads + self.segment_threads) * 2)
+        self.response_latencies = collections.deque(maxlen=200)
+        self.download_concurrency = updater.concurrency.DownloadConcurrency(threads, adaptive=adaptive)
+        self.__queue_bundles()
+        if engine == "asyncio":
+            self.async_engine = updater.aio.AsyncDownloadEngine(self, callback=callback, destination=destination)
+            self.async_pool = self.async_engine.pool
+            self.async_engine.start()
+        else:
+            for i in range(threads):
+                t = threading.Thread(target=self.__download_processor, daemon=True,
+                                     kwargs={"callback": callback, "destination": destination})
+                t.start()
         if wait:
             self.download_queue.join()
+            self.__stop_async_engine()
+            self.save_file_index()
         return
 
-    def start_validating(self, *, callback=None, threads=1, wait=False):
+    def start_pipeline(self, *, callback=None, destination=None, validate_threads=1, download_threads=1,
+                       engine="threads", adaptive=False, deep=False, backend="threads"):
+        """ Validate and download at the same time, downloading each file as soon as it is found to be stale.
+
+        Files which belong to a bundle are held back until validation finishes, since whether their bundle is worth
+        downloading depends on how many of its members are stale.  Blocks until both stages are done.
+
+        :param callable callback: A callback function to run after each validation and each download
+        :param str destination: The location to save the files
+        :param int validate_threads: The number of concurrent validation threads to spawn
+        :param int download_threads: The number of concurrent download threads, or of transfers for the asyncio engine
+        :param str engine: "threads" or "asyncio"
+        :param bool adaptive: Whether to tune how many validations and downloads run at once
+        :param bool deep: Whether to hash every file, even those the local index says are unchanged
+        :param str backend: "threads" or "processes", see start_validating
+        :return:
+        """
+        self.pipelined = True
+        self.bundle_members = []
+        # Both stages run the same callback, so they share a lock to keep it from running twice at once
+        validate_callback_lock = self.validate_callback_lock
+        self.validate_callback_lock = self.download_callback_lock
+        self.start_downloading(callback=callback, destination=destination, threads=download_threads, engine=engine,
+                               adaptive=adaptive)
+        self.start_validating(callback=callback, threads=validate_threads, wait=True, adaptive=adaptive, deep=deep,
+                              backend=backend)
+        self.pipelined = False
+        self.__queue_bundles(self.bundle_members)
+        self.download_queue.join()
+        self.__stop_async_engine()
+        self.validate_callback_lock = validate_callback_lock
+        self.save_file_index()
+        return
+
+    def start_validating(self, *, callback=None, threads=1, wait=False, adaptive=False, deep=False, backend="threads"):
         """ Spawn file validation processing threads.
 
         :param int threads: The number of concurrent threads to spawn
         :param callable callback: A callback function to run after each validation
         :param bool wait: Determines whether to block this function until the validate queue is empty
+        :param bool adaptive: Whether to tune how many of the threads run at once, up to the number given
+        :param bool deep: Whether to hash every file, even those the local index says are unchanged
+        :param str backend: "threads" to hash on the validation threads, or "processes" to hand hashing to a process
+                            pool with one worker per core, which is shut down once waiting for validation finishes
         :return:
         """
+        self.deep_verify = deep
+        if backend == "processes" and not self.hash_executor:
+            self.hash_executor = concurrent.futures.ProcessPoolExecutor()
+        self.validate_concurrency = updater.concurrency.ValidationConcurrency(threads, adaptive=adaptive)
         for i in range(threads):
             t = threading.Thread(target=self.__validate_processor, daemon=True, kwargs={"callback": callback})
             t.start()
         if wait:
             self.validate_queue.join()
+            self.__stop_hash_executor()
+            self.save_file_index()
+        return
+
+    def __stop_hash_executor(self):
+        """ Shut down the hashing process pool once validation is done with, so its workers don't outlive the check.
+
+        :return:
+        """
+        if self.hash_executor:
+            executor, self.hash_executor = self.hash_executor, None
+            executor.shutdown()
+        return
+
+    def __stop_async_engine(self):
+        """ Stop the asyncio engine once the download queue is done with, so its event loop thread doesn't linger.
+
+        :return:
+        """
+        if self.async_engine:
+            self.async_engine.stop()
+            self.async_engine = None
         return
 
     @staticmethod
@@ -194,23 +465,198 @@ class HashHandler:
                 return -1
         return 0
 
-    @staticmethod
-    def __get_hash(data):
-        """ Return the sha1 hash of some data.
+    def __get_hash(self, data):
+        """ Return the hash of some data.
 
         :param data: The data to hash
         :return: The hash
         """
-        return hashlib.sha1(data).hexdigest()
+        return updater.digest.get_hash(data, self.get_hash_algorithm())
+
+    def __hash_file(self, file_path):
+        """ Return the hash of a file, on the process pool if there is one.
+
+        :param str file_path: The file to hash
+        :return str: The hash
+        """
+        executor = self.hash_executor
+        if executor:
+            try:
+                future = executor.submit(updater.digest.hash_file, file_path, self.get_hash_algorithm(),
+                                         self.hash_block_size)
+            except RuntimeError:
+                # Validation finished and shut the pool down while a download was repairing a file
+                pass
+            else:
+                return future.result()
+        return updater.digest.hash_file(file_path, self.get_hash_algorithm(), self.hash_block_size)
+
+    def __fetch_hash(self, address, validators):
+        """ Download a hash file and parse its header.
+
+        The request is conditional on the validators of the cached copy, so an unchanged hash file costs a single 304
+        response and is then read from the cache.  A cached copy that can't be read or parsed is dropped and the hash
+        file fetched again unconditionally.
+
+        :param str address: The address of the hash file
+        :param dict validators: The ETag and Last-Modified of the cached copy, if there is one
+        :return tuple: The header, the data to parse later, the download time, the size of the download (None if the
+                       cached copy was used) and the validators of the new copy (None if the cached copy was used)
+        :raise ValueError: The hash file is invalid
+        """
+        cache_path = self.__hash_cache_path(address)
+        request = urllib.request.Request(address, headers={"Accept-Encoding": "gzip"})
+        if validators and cache_path and os.path.exists(cache_path):
+            if validators.get("etag"):
+                request.add_header("If-None-Match", validators["etag"])
+            if validators.get("last_modified"):
+                request.add_header("If-Modified-Since", validators["last_modified"])
+        start_time = time.perf_counter()
+        try:
+            with self.pool.urlopen(request, timeout=self.hash_deadline) as response:
+                data = response.read()
+                if response.headers.get("Content-Encoding", "").lower() == "gzip":
+                    data = updater.codec.decompress("gzip", data)
+                validators = {"etag": response.headers.get("ETag"),
+                              "last_modified": response.headers.get("Last-Modified")}
+            size = len(data)
+            if cache_path and (validators["etag"] or validators["last_modified"]):
+                try:
+                    self.__save_file(data, cache_path)
+                except OSError:
+                    self.log.warning("Could not cache hash file " + address, tb=True)
+                    validators = None
+            else:
+                validators = None
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise
+            try:
+                with open(cache_path, 'rb') as file:
+                    data = file.read()
+                header, data = self.__parse_hash(data)
+            except (OSError, ValueError):
+                self.log.warning("Cached copy of hash file " + address + " is unusable, fetching it again", tb=True)
+                return self.__fetch_hash(address, None)
+            return header, data, time.perf_counter() - start_time, None, None
+        download_time = time.perf_counter() - start_time
+        header, data = self.__parse_hash(data)
+        return header, data, download_time, size, validators
 
     @staticmethod
-    def __read_file(file_path):
-        """ Open a file and return its contents.
+    def __parse_hash(data):
+        """ Parse the header of a hash file.
+
+        :param bytes data: The hash file
+        :return tuple: The header and the data to parse later
+        :raise ValueError: The hash file is invalid
+        """
+        if updater.manifest.is_compact(data):
+            return updater.manifest.read_header(data), data
+        data = json.loads(data.decode("utf-8"))
+        return data, data
+
+    def __hash_cache_path(self, address):
+        """ Return where the cached copy of a hash file is kept.
+
+        :param str address: The address of the hash file
+        :return str: The path, or None if there is no cache directory
+        """
+        if not self.cache_dir:
+            return None
+        if not os.path.exists(self.cache_dir):
+            self.__create_path(self.cache_dir)
+        return os.path.join(self.cache_dir, "hash-" + hashlib.sha1(address.encode("utf-8")).hexdigest() + ".cache")
+
+    @staticmethod
+    def __rank_mirrors(addresses, health):
+        """ Sort addresses from the best to the worst recorded history.
+
+        Addresses with no history come after those with a clean one, and recent failures push an address further back.
+
+        :param list addresses: The addresses to sort
+        :param dict health: The recorded history of each address
+        :return list:
+        """
+        def score(address):
+            stats = health.get(address)
+            if not stats or stats["latency"] is None:
+                return (1, stats["failures"] if stats else 0, 0)
+            return (0, stats["failures"], stats["latency"] + 1 / max(stats["throughput"] or 0, 1))
+        return sorted(addresses, key=score)
 
-        :param str file_path: The file to read
-        :return str: The file contents
+    def __record_mirror(self, health, address, download_time=None, size=0):
+        """ Update the recorded history of a mirror.
+
+        :param dict health: The recorded history of each address
+        :param str address: The mirror's address
+        :param float download_time: How long the download took, or None if it failed
+        :param int size: The size of the download, or None if nothing was downloaded
+        :return:
         """
-        return open(file_path, 'rb').read()
+        stats = health.setdefault(address, {"latency": None, "throughput": None, "failures": 0})
+        if download_time is None:
+            stats["failures"] += 1
+            return
+        if stats["latency"] is None:
+            stats["latency"] = download_time
+        else:
+            # Weight recent runs more heavily so a mirror can recover from a bad day
+            stats["latency"] += self.mirror_smoothing * (download_time - stats["latency"])
+        # A cached response says nothing about throughput
+        if size is not None:
+            throughput = size / max(download_time, 1e-6)
+            if stats["throughput"] is None:
+                stats["throughput"] = throughput
+            else:
+                stats["throughput"] += self.mirror_smoothing * (throughput - stats["throughput"])
+        stats["failures"] = 0
+        stats["last_success"] = time.time()
+        return
+
+    def __is_installed(self, path):
+        """ Check whether a directory is unchanged since the last successful install.
+
+        :param list path: The path of the directory
+        :return bool:
+        """
+        dir_hash = self.hash_dict.get("dirs", {}).get(str.join("/", path))
+        return dir_hash is not None and self.installed_dirs.get(str.join("/", path)) == dir_hash
+
+    def __load_state(self, name):
+        """ Load a JSON state file from the cache directory.
+
+        :param str name: The file name
+        :return dict: The state, or an empty dictionary if there is none
+        """
+        if not self.cache_dir:
+            return {}
+        try:
+            with open(os.path.join(self.cache_dir, name), 'rt') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def __save_state(self, name, state):
+        """ Save a JSON state file to the cache directory.
+
+        :param str name: The file name
+        :param dict state: The state to save
+        :return:
+        """
+        if not self.cache_dir:
+            return
+        try:
+            if not os.path.exists(self.cache_dir):
+                self.__create_path(self.cache_dir)
+            # Write to a temporary file first so a crash never leaves a half written state file
+            temp_path = os.path.join(self.cache_dir, name + ".tmp")
+            with open(temp_path, 'wt') as file:
+                json.dump(state, file, separators=(",", ":"))
+            os.replace(temp_path, os.path.join(self.cache_dir, name))
+        except OSError:
+            self.log.warning("Could not save " + name, tb=True)
+        return
 
     def __create_path(self, path):
         base = os.path.split(path)[0]
@@ -221,6 +667,9 @@ class HashHandler:
     def __save_file(self, data, file_path):
         """ Save data to a file.
 
+        The data is written to a temporary file first and moved over the file once it is safely on disk, so a crash
+        never leaves a truncated file in place.
+
         :param data: The data to save
         :param str file_path: The file to save to
         :return:
@@ -228,24 +677,65 @@ class HashHandler:
         folder = os.path.split(file_path)[0]
         if not os.path.exists(folder):
             self.__create_path(folder)
-        file = open(file_path, 'wb')
-        file.write(data)
-        file.close()
+        temp_path = file_path + ".tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, file_path)
         return
 
-    def __validate_file(self, file_path, file_name, file_hash):
+    def __validate_file(self, entry):
         """ Validate that the file matches its hash.
 
-        :param str file_path: The path of the file
-        :param str file_name: The name of the file
-        :param str file_hash: The hash of the file
+        The hash of the local copy is stored in the entry so that a download can pick a delta based on it.  A file whose
+        size, modification time and inode haven't changed since it was last hashed or written is taken from the local
+        index instead of being hashed again, unless this is a deep verify.  A file of the wrong size fails without being
+        read, unless its hash is needed to pick a delta or it can be repaired chunk by chunk.
+
+        :param dict entry: The file's entry in the hash dictionary
         :return bool: True if the file validates, False if it does not
         """
-        full_path = os.path.join(file_path, file_name)
-        if os.path.exists(full_path) and self.__get_hash(self.__read_file(full_path)) == file_hash:
-            return True
-        else:
+        full_path = os.path.join(entry["path"], entry["name"])
+        key = self.__index_key(entry)
+        entry["hashed_size"] = 0
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            self.file_index.pop(key, None)
+            entry["local_hash"] = None
+            entry["local_size"] = 0
             return False
+        signature = [stat.st_size, stat.st_mtime_ns, stat.st_ino, self.get_hash_algorithm()]
+        indexed = self.file_index.get(key)
+        entry["local_size"] = stat.st_size
+        if not self.deep_verify and indexed and indexed[:4] == signature:
+            entry["local_hash"] = indexed[4]
+        elif stat.st_size != entry.get("size", stat.st_size) and "deltas" not in entry and "chunks" not in entry:
+            entry["local_hash"] = None
+        else:
+            entry["local_hash"] = self.__hash_file(full_path)
+            entry["hashed_size"] = stat.st_size
+            self.file_index[key] = signature + [entry["local_hash"]]
+        return entry["local_hash"] == entry["hash"]
+
+    def _index_file(self, entry, path):
+        """ Record a file which was just written in the local index, so the next validation doesn't have to hash it.
+
+        :param dict entry: The file's entry in the hash dictionary
+        :param str path: The location of the file
+        :return:
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        self.file_index[self.__index_key(entry)] = [stat.st_size, stat.st_mtime_ns, stat.st_ino,
+                                                    self.get_hash_algorithm(), entry["hash"]]
+
+    @staticmethod
+    def __index_key(entry):
+        return entry["path"] + "/" + entry["name"] if entry["path"] else entry["name"]
 
     def __validate_processor(self, callback=None):
         """ A processor task which keeps checking a queue for more files to validate.
@@ -259,31 +749,509 @@ class HashHandler:
                 time.sleep(1)
             # Get the validation entry
             entry = self.validate_queue.get()
-            # If the file does not validate, add it to the download queue
-            if not self.__validate_file(entry["path"], entry["name"], entry["hash"]):
-                self.download_queue.put(entry)
+            self.validate_concurrency.acquire()
+            start_time = time.perf_counter()
+            try:
+                valid = self.__validate_file(entry)
+            finally:
+                self.validate_concurrency.release()
+            # Only the bytes actually hashed say anything about how fast the disk is going
+            self.validate_concurrency.record(entry["hashed_size"], time.perf_counter() - start_time)
+            # If the file does not validate, add it to the download queue, counting it first so progress stays in step
+            if not valid:
                 self.downloads_total_counter += 1
+                if self.pipelined and "bundle" in entry:
+                    self.bundle_members.append(entry)
+                else:
+                    self.download_queue.put(entry)
+            self.validations_completed_counter += 1
             # Either way, mark the task as done
             self.validate_queue.task_done()
             if callback and callable(callback):
                 with self.validate_callback_lock:
                     callback()
 
-    def __download_file(self, source, destination, validation_hash=None):
-        """ Download a file.
+    def __fetch(self, source, headers=None, writer=None, partial=False, exclude=None):
+        """ Download something from the mirror expected to be fastest right now.
+
+        A mirror which is slow to answer has the request hedged on another mirror, and a transfer which slows to a
+        trickle is abandoned so it can be retried elsewhere.
+
+        :param str source: The path to download, relative to a mirror's host
+        :param dict headers: Extra request headers
+        :param updater.stream.VerifiedWriter writer: Where to stream the body to, instead of returning it
+        :param bool partial: Whether to fail unless the server sends the requested range
+        :param list exclude: Mirrors to avoid, which any mirror that fails is added to
+        :return tuple: The response body (empty if it went to the writer), the HTTP status and the response headers
+        :raise ValueError: The server ignored a range which had to be honoured
+        :raise HashHandler.DownloadStalledException: The transfer fell below the minimum throughput
+        """
+        host, response, start_time = self.__open(source, headers, writer, exclude)
+        latency = time.perf_counter() - start_time
+        stall = updater.concurrency.StallDetector(self.stall_throughput, self.stall_window)
+        blocks = []
+        size = 0
+        try:
+            with response:
+                if partial and response.status != 206:
+                    raise ValueError
+                if writer:
+                    self._start_response(writer, host, response.status, response.headers)
+                # Take blocks as they arrive, so a trickle is noticed without waiting for a whole block
+                for data in iter(lambda: response.read1(self.block_size), b""):
+                    if self.rate_limiter:
+                        # Time spent under the bandwidth cap doesn't count against the mirror
+                        stall.pause(self.rate_limiter.consume(len(data)))
+                    if stall.update(len(data)):
+                        raise self.DownloadStalledException("Transfer stalled: " + self._make_url(host, source))
+                    size += len(data)
+                    if writer:
+                        writer.write(data)
+                    else:
+                        blocks.append(data)
+                status = response.status
+                response_headers = response.headers
+        except:
+            self._fail_mirror(host, exclude)
+            self.download_concurrency.record(size, 0, ok=False)
+            raise
+        self.mirrors.finish(host, size, time.perf_counter() - start_time)
+        self.download_concurrency.record(size, latency)
+        return b"".join(blocks), status, response_headers
+
+    def __open(self, source, headers, writer, exclude):
+        """ Send a request, hedging it on another mirror if no response comes back in the usual time.
+
+        Whichever request answers first is used, and the other is closed as soon as it answers.
+
+        :param str source: The path to download, relative to a mirror's host
+        :param dict headers: Extra request headers
+        :param updater.stream.VerifiedWriter writer: The download the request continues, if any
+        :param list exclude: Mirrors to avoid, which any mirror that fails is added to
+        :return tuple: The mirror which answered first, its response, and when the request to it was sent
+        :raise: The error from the last request to fail, if they all failed
+        """
+        def send(host):
+            request = urllib.request.Request(self._make_url(host, source),
+                                             headers=self._resume_headers(writer, host, headers))
+            return self.pool.urlopen(request, timeout=self.request_timeout)
+
+        host = self.mirrors.choose(exclude)
+        attempts = {self.request_executor.submit(send, host): (host, time.perf_counter())}
+        self.requests_sent += 1
+        hedge_delay = self._hedge_delay()
+        if hedge_delay is not None and not concurrent.futures.wait(attempts, timeout=hedge_delay)[0]:
+            self.log.info("Hedging slow request: " + source)
+            self.hedges_sent += 1
+            hedge_host = self.mirrors.choose(list(exclude or []) + [host])
+            attempts[self.request_executor.submit(send, hedge_host)] = (hedge_host, time.perf_counter())
+        pending = set(attempts)
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            winner = None
+            for future in done:
+                attempt_host, sent = attempts[future]
+                try:
+                    response = future.result()
+                except Exception as e:
+                    self._fail_mirror(attempt_host, exclude, e)
+                    error = e
+                    continue
+                if winner is None:
+                    winner = attempt_host, response, sent
+                else:
+                    response.close()
+                    self.mirrors.cancel(attempt_host)
+            if winner:
+                for future in pending:
+                    future.add_done_callback(lambda future, loser=attempts[future][0]: self.__discard(loser, future))
+                self.response_latencies.append(time.perf_counter() - winner[2])
+                return winner
+        raise error
+
+    def _hedge_delay(self):
+        """ Work out how long to wait for a response before hedging the request on another mirror.
+
+        The wait is the usual worst case response time, so only the slowest few requests are hedged.  Hedges are also
+        capped at a small share of all requests, so a struggling mirror isn't buried under duplicates.
+
+        :return float: The delay, or None if the request shouldn't be hedged
+        """
+        if len(self.mirrors.hosts) < 2 or len(self.response_latencies) < self.hedge_min_samples or \
+                self.hedges_sent >= self.hedge_budget * self.requests_sent:
+            return None
+        latencies = sorted(self.response_latencies)
+        return max(self.hedge_min_delay, latencies[int(len(latencies) * self.hedge_percentile)])
+
+    def __discard(self, host, future):
+        """ Close the losing request of a hedged pair once it answers.
+
+        :param str host: The mirror the request went to
+        :param concurrent.futures.Future future: The request
+        :return:
+        """
+        try:
+            response = future.result()
+        except Exception as e:
+            self._fail_mirror(host, None, e)
+            return
+        response.close()
+        self.mirrors.cancel(host)
+
+    def _fail_mirror(self, host, exclude, error=None):
+        """ Record a failed request, so the retry goes to a different mirror.
+
+        Only a mirror which couldn't be reached, stalled or answered with a server error is penalised.  A 4xx response
+        is a normal answer, such as a 416 for a file which has nothing left to send or a 404 for a delta the mirror
+        doesn't have, so the mirror stays in rotation.
+
+        :param str host: The mirror which failed
+        :param list exclude: Mirrors the download should avoid, if it is tracking them
+        :param Exception error: The error the request failed with, if it is known
+        :return:
+        """
+        if isinstance(error, urllib.error.HTTPError) and 400 <= error.code < 500:
+            self.mirrors.cancel(host)
+            return
+        self.mirrors.fail(host)
+        if exclude is not None and host not in exclude:
+            exclude.append(host)
+
+    @staticmethod
+    def _resume_headers(writer, host, headers):
+        """ Add an If-Range header to a range request resuming a download from the same mirror it started on.
+
+        Validators are only comparable between requests to the same server.  A download resumed from another mirror
+        relies on the hash check at the end instead.
+
+        :param updater.stream.VerifiedWriter writer: The download being resumed, if any
+        :param str host: The mirror the request is going to
+        :param dict headers: The request headers
+        :return dict: The request headers to send
+        """
+        headers = dict(headers or {})
+        if writer and writer.meta and writer.meta.get("host") == host and "Range" in headers:
+            etag = writer.meta.get("etag")
+            # Weak entity tags can't be used with If-Range
+            validator = etag if etag and not etag.startswith("W/") else writer.meta.get("last_modified")
+            if validator:
+                headers["If-Range"] = validator
+        return headers
+
+    def _start_response(self, writer, host, status, headers):
+        """ Line a download up with the response about to be streamed into it.
+
+        A server which sends the whole file rather than the requested range starts the download again.  Files large
+        enough to be worth resuming are recorded along with the mirror and validators they came from.
+
+        :param updater.stream.VerifiedWriter writer: The download
+        :param str host: The mirror the response came from
+        :param int status: The HTTP status
+        :param headers: The response headers
+        :return:
+        :raise ValueError: The server sent a range starting somewhere other than where the download is up to
+        """
+        if status == 206:
+            start = headers.get("Content-Range", "").partition(" ")[2].partition("-")[0]
+            if not start.isdigit() or int(start) != writer.received:
+                raise ValueError("Unexpected range: " + headers.get("Content-Range", ""))
+            total = self._content_range_total(headers)
+        else:
+            if writer.received:
+                # The file changed or the server ignored the range, so start again from the beginning
+                writer.reset()
+            length = headers.get("Content-Length", "")
+            total = int(length) if length.isdigit() else None
+        if total is not None and total >= self.resume_min_size:
+            writer.record({"host": host, "etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")})
+
+    def __fetch_segment(self, source, start, end):
+        """ Download one byte range of a file, moving to another mirror if one fails.
 
-        :param str source: The address to download from
+        :param str source: The path to download, relative to a mirror's host
+        :param int start: The first byte to download
+        :param int end: The last byte to download
+        :return bytes: The segment
+        :raise ValueError: The segment did not come back as requested
+        """
+        exclude = []
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                data, status, headers = self.__fetch(source, {"Range": "bytes={0}-{1}".format(start, end)},
+                                                     partial=True, exclude=exclude)
+                if len(data) != end - start + 1:
+                    raise ValueError
+                return data
+            except:
+                if attempt >= self.max_attempts:
+                    raise
+                self.log.warning("Segment failed: {0} bytes {1}-{2}".format(source, start, end), tb=True)
+                time.sleep(self._backoff(attempt))
+
+    @staticmethod
+    def _content_range_total(headers):
+        """ Read the full size of a file from the Content-Range header of a partial response.
+
+        :param headers: The response headers
+        :return int: The size, or None if the server did not say
+        """
+        total = headers.get("Content-Range", "").rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+
+    def __download_file(self, source, destination, validation_hash=None, codec=updater.codec.DEFAULT_CODEC,
+                        exclude=None, size=None):
+        """ Stream a file to disk, in parallel segments if it is large enough.
+
+        Each block is decompressed and hashed as it arrives and written to a temporary file beside the destination,
+        which only replaces the destination once the hash matches.  The first segment is requested on its own, which
+        also tells us how large the file is.  A file no larger than the segment threshold is then finished with one more
+        request, anything larger has the rest of its segments fetched a few at a time and written out in order.  Large
+        files carry on from any partial download an earlier attempt or session left behind.  A file the hash file says
+        fits in one segment is fetched with a plain request.
+
+        :param str source: The path to download from, relative to a mirror's host
         :param str destination: The location to save the file
         :param str validation_hash: The hash to validate against
+        :param str codec: The codec the file was compressed with
+        :param list exclude: Mirrors to avoid, which any mirror that fails is added to
+        :param int size: The compressed size of the file, if the hash file has it
         :return:
         :raise ValueError: The download integrity could not be validated
         """
-        data = urllib.request.urlopen(source, context=self.ssl_context).read()
-        if source.endswith(".gz"):
-            data = zlib.decompress(data, 15+32)
-        if hash and not self.__get_hash(data) == validation_hash:
+        writer = updater.stream.VerifiedWriter(destination, codec, validation_hash, self.get_hash_algorithm())
+        futures = collections.deque()
+        try:
+            if writer.resume():
+                self.log.info("Resuming {0} from byte {1}".format(destination, writer.received))
+            try:
+                data, status, headers = self.__fetch(source, self._first_range(writer, size), writer,
+                                                     exclude=exclude)
+            except urllib.error.HTTPError as e:
+                if not self._range_satisfied(e, writer):
+                    raise
+                status, headers = e.code, e.headers
+            rest, segments = self._plan_rest(writer, status, headers)
+            if rest:
+                self.__fetch(source, rest, writer, partial=True, exclude=exclude)
+            for start, end in segments:
+                # Only keep a few segments in memory, writing out the oldest before fetching another
+                if len(futures) >= self.segment_threads:
+                    writer.write(futures.popleft().result())
+                futures.append(self.segment_executor.submit(self.__fetch_segment, source, start, end))
+            while futures:
+                writer.write(futures.popleft().result())
+            writer.commit()
+        except ValueError:
+            for future in futures:
+                future.cancel()
+            writer.abort()
+            raise
+        except:
+            for future in futures:
+                future.cancel()
+            # Keep whatever arrived in order so the next attempt can carry on from there
+            writer.close()
+            raise
+        return
+
+    def _first_range(self, writer, size=None):
+        """ Build the range request for the first segment of a download, from wherever it is up to.
+
+        :param updater.stream.VerifiedWriter writer: The download
+        :param int size: The compressed size of the file, if the hash file has it
+        :return dict: The request headers, without a range if the whole file fits in the first segment
+        """
+        if not writer.received and size is not None and size <= self.segment_size:
+            return {}
+        return {"Range": "bytes={0}-{1}".format(writer.received, writer.received + self.segment_size - 1)}
+
+    def _plan_rest(self, writer, status, headers):
+        """ Work out how to fetch the rest of a download once its first response has been streamed into it.
+
+        A file no larger than the segment threshold is finished with one more request, anything larger is split into
+        segments.  A server which ignores the range sends the whole file, so there is nothing left to fetch.
+
+        :param updater.stream.VerifiedWriter writer: The download
+        :param int status: The HTTP status of the first response
+        :param headers: The headers of the first response
+        :return tuple: The headers of a single request for the rest (None if it isn't needed), and the first and last
+                       byte of each segment to fetch instead
+        """
+        total = self._content_range_total(headers) if status == 206 else None
+        if total is None or total <= writer.received:
+            return None, []
+        if total <= self.segment_threshold:
+            return {"Range": "bytes={0}-{1}".format(writer.received, total - 1)}, []
+        return None, [(start, min(start + self.segment_size, total) - 1)
+                      for start in range(writer.received, total, self.segment_size)]
+
+    def _range_satisfied(self, error, writer):
+        """ Check whether a 416 response means there was nothing left to download.
+
+        That happens when an earlier attempt already received the whole file, or when the file is empty.
+
+        :param urllib.error.HTTPError error: The error response
+        :param updater.stream.VerifiedWriter writer: The download
+        :return bool:
+        """
+        return error.code == 416 and (writer.received > 0 or self._content_range_total(error.headers) == 0)
+
+    def __patch_file(self, source, destination, validation_hash):
+        """ Download a binary delta and apply it to the existing copy of a file.
+
+        :param str source: The path of the delta, relative to a mirror's host
+        :param str destination: The location of the file to patch
+        :param str validation_hash: The hash to validate against
+        :return:
+        :raise ValueError: The patched file's integrity could not be validated
+        """
+        delta = updater.codec.decompress("gzip", self.__fetch(source)[0])
+        # The patched file is hashed as it is written, and only replaces the local copy once it validates
+        writer = updater.stream.VerifiedWriter(destination, "store", validation_hash, self.get_hash_algorithm())
+        try:
+            with open(destination, 'rb') as base_file:
+                updater.delta.apply_delta(base_file, delta, writer)
+            writer.commit()
+        except:
+            writer.abort()
+            raise
+        return
+
+    def __repair_file(self, entry, destination):
+        """ Repair the chunks of a file which don't match their hashes.
+
+        Each run of mismatched chunks is fetched with a single range request, since every chunk is stored as its own
+        compressed member.
+
+        :param dict entry: The file's entry in the hash dictionary
+        :param str destination: The location of the file to repair
+        :return:
+        :raise ValueError: The repaired file's integrity could not be validated
+        """
+        chunk_size = entry["chunk_size"]
+        chunks = entry["chunks"]
+        with open(destination, 'r+b') as file:
+            file.truncate(entry["size"])
+            # Find the runs of chunks which need to be fetched
+            runs = []
+            for index, chunk in enumerate(chunks):
+                file.seek(index * chunk_size)
+                if self.__get_hash(file.read(chunk_size)) == chunk[0]:
+                    continue
+                if runs and runs[-1][1] == index:
+                    runs[-1][1] = index + 1
+                else:
+                    runs.append([index, index + 1])
+            for first, last in runs:
+                start = chunks[first][1]
+                end = chunks[last - 1][1] + chunks[last - 1][2] - 1
+                data, status, headers = self.__fetch(entry["source"], {"Range": "bytes={0}-{1}".format(start, end)})
+                if status != 206:
+                    raise ValueError
+                data = updater.codec.decompress(entry["codec"], data)
+                for index in range(first, last):
+                    chunk = data[(index - first) * chunk_size:(index - first + 1) * chunk_size]
+                    if not self.__get_hash(chunk) == chunks[index][0]:
+                        raise ValueError
+                    file.seek(index * chunk_size)
+                    file.write(chunk)
+        # The chunks only cover the parts that were fetched, so check the whole file too
+        if not self.__hash_file(destination) == entry["hash"]:
             raise ValueError
-        self.__save_file(data, destination)
+        return
+
+    def __download_bundle(self, bundle, destination):
+        """ Download the members of a bundle which need updating with a single request.
+
+        Only the byte range spanning the needed members is requested.  Any member which can't be extracted from the
+        bundle goes back on the download queue to be downloaded by itself.
+
+        :param dict bundle: The bundle task built by __queue_bundles
+        :param str destination: The location to save the files
+        :return:
+        """
+        members, start, end = self._bundle_range(bundle)
+        try:
+            data, status, headers = self.__fetch(bundle["source"], {"Range": "bytes={0}-{1}".format(start, end)})
+        except:
+            self._bundle_failed(bundle, members)
+            return
+        self._extract_bundle(members, data, start if status == 206 else 0, destination)
+        return
+
+    @staticmethod
+    def _bundle_range(bundle):
+        """ Find the byte range of a bundle spanning the members which need updating.
+
+        :param dict bundle: The bundle task built by __queue_bundles
+        :return tuple: The members sorted by offset, and the first and last byte to request
+        """
+        members = sorted(bundle["members"], key=lambda member: member["bundle"][1])
+        start = members[0]["bundle"][1]
+        end = max(member["bundle"][1] + member["bundle"][2] for member in members) - 1
+        return members, start, end
+
+    def _bundle_failed(self, bundle, members):
+        """ Queue the members of a bundle which couldn't be downloaded to be downloaded by themselves.
+
+        :param dict bundle: The bundle task built by __queue_bundles
+        :param list members: The members which were to be extracted from it
+        :return:
+        """
+        self.log.warning("Bundle download failed: " + bundle["name"], tb=True)
+        for member in members:
+            self.download_queue.put(member)
+        return
+
+    def _extract_bundle(self, members, data, base, destination):
+        """ Save the members of a bundle from the downloaded part of it.
+
+        A server which ignores the range sends the whole bundle, which then starts at offset 0.
+
+        :param list members: The members to extract
+        :param bytes data: The downloaded part of the bundle
+        :param int base: The offset in the bundle which the data starts at
+        :param str destination: The location to save the files
+        :return:
+        """
+        for member in members:
+            try:
+                offset, length = member["bundle"][1] - base, member["bundle"][2]
+                member_data = updater.codec.decompress(member["codec"], data[offset:offset + length])
+                if not self.__get_hash(member_data) == member["hash"]:
+                    raise ValueError
+                member_path = os.path.join(destination, member["path"], member["name"])
+                self.__save_file(member_data, member_path)
+                self._file_downloaded(member, member_path)
+            except:
+                self.log.warning("Bundle member failed: " + member["name"], tb=True)
+                self.download_queue.put(member)
+        return
+
+    def __queue_bundles(self, entries=None):
+        """ Replace the queued files which share a bundle with a single task to download the bundle.
+
+        Files are only downloaded through their bundle when enough of its members need updating.
+        :param list entries: Files to queue, instead of the ones already in the queue
+        :return:
+        """
+        if entries is None:
+            entries = []
+            while not self.download_queue.empty():
+                entries.append(self.download_queue.get())
+                self.download_queue.task_done()
+        bundles = {}
+        for entry in entries:
+            if "bundle" in entry:
+                bundles.setdefault(entry["bundle"][0], []).append(entry)
+        for entry in entries:
+            if "bundle" not in entry or len(bundles[entry["bundle"][0]]) < self.bundle_min_members:
+                self.download_queue.put(entry)
+        for bundle_id, members in bundles.items():
+            if len(members) >= self.bundle_min_members:
+                self.download_queue.put({"name": bundle_id, "members": members,
+                                         "source": self._make_url("bundles", bundle_id)})
         return
 
     def __download_processor(self, *, callback=None, destination):
@@ -296,35 +1264,118 @@ class HashHandler:
             # If the queue is empty, wait a while before checking again
             if self.download_queue.empty():
                 time.sleep(1)
-            # Get the download entry
+            # Get the download entry, then wait for the controller to let another download run
             entry = self.download_queue.get()
+            self.download_concurrency.acquire()
+            if "members" in entry:
+                # Bundles handle their own failures by queueing their members individually
+                self.__download_bundle(entry, destination)
+                self._download_done(callback)
+                continue
             # Retry the download until a success or an exception handler breaks out
             while True:
                 try:
                     # Increment the attempt counter and try to download
                     entry["attempted"] += 1
                     path = os.path.join(destination, entry["path"], entry["name"])
-                    self.__download_file(entry["url"], path, entry["hash"])
+                    if not self._update_local_copy(entry, path):
+                        self.__download_file(entry["source"], path, entry["hash"], entry["codec"],
+                                             entry.setdefault("failed_hosts", []), entry.get("csize"))
                     # If you get this far, the download succeeded - break from the retry loop
-                    self.downloads_completed_counter += 1
+                    self._file_downloaded(entry, path)
                     break
                 except:
-                    if entry["attempted"] < self.max_attempts:
-                        # Log the exception
-                        self.log.warning("Download failed: " + entry["name"], tb=True)
-                    else:
-                        # If the max number of attempts has been reached, log it and break from the retry loop
-                        self.log.error("Download failed: " + entry["name"], tb=True)
-                        self.downloads_failed_list.append(entry)
+                    delay = self._retry_delay(entry)
+                    if delay is None:
                         break
+                    time.sleep(delay)
             # Whether successful or not, this task is now down
-            self.download_queue.task_done()
-            if callback and callable(callback):
-                with self.download_callback_lock:
-                    callback()
+            self._download_done(callback)
+
+    def _file_downloaded(self, entry, path):
+        """ Record a file which is now up to date on disk.
+
+        :param dict entry: The file's entry in the hash dictionary
+        :param str path: The location of the file
+        :return:
+        """
+        self._index_file(entry, path)
+        self.downloads_completed_counter += 1
+        return
+
+    def _download_done(self, callback=None):
+        """ Finish a download task, successful or not, and let the next one run.
+
+        :param callable callback: A callback function to run after each download
+        :return:
+        """
+        self.download_concurrency.release()
+        self.download_queue.task_done()
+        if callback and callable(callback):
+            with self.download_callback_lock:
+                callback()
+        return
+
+    def _update_local_copy(self, entry, path):
+        """ Bring the local copy of a file up to date without downloading all of it, if the hash file allows it.
+
+        :param dict entry: The file's entry in the hash dictionary
+        :param str path: The location of the local copy
+        :return bool: True if the file is now up to date, False if it needs to be downloaded in full
+        """
+        if entry.get("local_hash") in entry.get("deltas", []):
+            try:
+                # Patch the local copy if there is a delta from it, falling back to the full file
+                delta_name = entry["local_hash"] + "_" + entry["hash"] + updater.codec.get_extension("gzip")
+                self.__patch_file(self._make_url("deltas", delta_name), path, entry["hash"])
+                return True
+            except:
+                self.log.warning("Patch failed: " + entry["name"], tb=True)
+                entry["local_hash"] = None
+        if "chunks" in entry and entry.get("local_hash"):
+            try:
+                # Fetch only the damaged chunks of the local copy, falling back to the full file
+                self.__repair_file(entry, path)
+                return True
+            except:
+                self.log.warning("Repair failed: " + entry["name"], tb=True)
+                entry["local_hash"] = None
+        return False
+
+    def _retry_delay(self, entry):
+        """ Log a failed download attempt and work out how long to wait before the next one.
+
+        The file is given up on once it has used all of its attempts, or when the next attempt would start after its
+        retry window closes.
+
+        :param dict entry: The file's entry in the hash dictionary
+        :return float: The seconds to wait before trying again, or None to give up
+        """
+        now = time.monotonic()
+        deadline = entry.setdefault("retry_deadline", now + self.retry_window)
+        delay = self._backoff(entry["attempted"])
+        if entry["attempted"] < self.max_attempts and now + delay < deadline:
+            # Log the exception
+            self.log.warning("Download failed: " + entry["name"], tb=True)
+            return delay
+        # If the max number of attempts has been reached, log it and give up
+        self.log.error("Download failed: " + entry["name"], tb=True)
+        self.downloads_failed_list.append(entry)
+        return None
+
+    def _backoff(self, attempt):
+        """ Pick how long to wait after a failed attempt.
+
+        The wait grows exponentially, and is drawn at random up to that limit so that downloads which failed together
+        don't all retry together.
+
+        :param int attempt: The number of attempts made so far
+        :return float: The seconds to wait
+        """
+        return random.uniform(0, min(self.retry_backoff_max, self.retry_backoff * 2 ** (attempt - 1)))
 
     @staticmethod
-    def __make_url(*args):
+    def _make_url(*args):
         return os.path.join(*args).replace("\\", "/").replace(" ", "%20")
 
     class DownloadException(Exception):
@@ -335,3 +1386,6 @@ class HashHandler:
 
     class DownloadMaxAttemptException(DownloadException):
         pass
+
+    class DownloadStalledException(DownloadException):
+        pass
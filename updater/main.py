@@ -15,6 +15,7 @@ import tkinter.messagebox
 import tkinter.simpledialog
 import tkinter.ttk
 import updater.cfg
+import updater.connection
 import updater.hash
 import updater.lang
 import updater.log
@@ -73,6 +74,7 @@ class Main:
         self.log = updater.log.Logger(os.path.join(self.script_path, self.script_name + ".log"),
                                       logging_level=self.cfg.logging_level())
         sys.excepthook = self.log.unhandled
+        self.connection_pool = updater.connection.ConnectionPool()
         self.log.debug("Updater Launched - " + self.cfg.updater_version())
 
         # Parse any arguments passed in
@@ -191,6 +193,8 @@ class Main:
         self.logging_level.set(self.cfg.logging_level())
         self.language = StringVar()
         self.language.set(self.cfg.language(default=self.args.language))
+        self.deep_verify = BooleanVar()
+        self.deep_verify.set(self.cfg.deep_verify())
         self.status = StringVar()
         self.status.set(self.lang.sta_ready())
         # Build the menu bar
@@ -226,6 +230,8 @@ class Main:
                                         variable=self.logging_level, command=self.set_logging_level())
         self.debug_menu.add_radiobutton(label="Critical", value=self.log.CRITICAL,
                                         variable=self.logging_level, command=self.set_logging_level())
+        self.debug_menu.add_separator()
+        self.debug_menu.add_checkbutton(label="Deep Verify", variable=self.deep_verify, command=self.set_deep_verify)
         # Help menu
         self.help_menu = Menu(self.main_menu)
         self.help_menu.add_command(label=self.lang.act_about(), command=self.display_about)
@@ -405,7 +411,8 @@ class Main:
         self.set_progressbar_pulsing()
         # Check if the updater has an update available
         self.log.debug("Initialize the UpdateHandler")
-        self_updater = updater.update.UpdateHandler(self.log)
+        self_updater = updater.update.UpdateHandler(self.log, pool=self.connection_pool,
+                                                    timeout=self.cfg.request_timeout())
         self.log.debug("Get the updater version available")
         updater_version = self_updater.get_version_available(self.cfg.self_update_address())
         self.log.info("Updater " + str(updater_version) + " is available.")
@@ -429,7 +436,13 @@ class Main:
                 self.log.debug("Self update declined")
         self.hash_handler = updater.hash.HashHandler(addresses=self.cfg.hash_addresses()[self.channel.get()],
                                                      max_attempts=self.cfg.max_download_attempts(),
-                                                     logging=self.log)
+                                                     logging=self.log,
+                                                     cache_dir=os.path.join(self.working_dir, self.cfg.cache_dir()),
+                                                     segment_size=self.cfg.download_segment_size(),
+                                                     segment_threshold=self.cfg.download_segment_threshold(),
+                                                     pool=self.connection_pool,
+                                                     bandwidth_limit=self.cfg.bandwidth_limit() * 1024,
+                                                     request_timeout=self.cfg.request_timeout())
         # Load the best hash file
         self.hash_handler.download_hash()
         # Check if a hash was not found
@@ -448,18 +461,35 @@ class Main:
         # Validate local files
         self.status.set(self.lang.sta_checking_files())
         self.set_progressbar_pulsing()
-        self.hash_handler.build_validate_queue()
-        self.hash_handler.start_validating(threads=8, wait=True)
-        # Check if there is anything to update
-        self.set_progressbar_value()
-        if self.hash_handler.download_queue.empty():
+        self.hash_handler.build_validate_queue(deep=self.deep_verify.get())
+        engine = self.cfg.download_engine()
+        threads = self.cfg.download_transfers() if engine == "asyncio" else self.cfg.download_threads()
+        if self.cfg.pipelined_update():
+            # Download each stale file as soon as it is found
+            self.hash_handler.start_pipeline(callback=self.__mod_file_pipeline_callback, destination=self.working_dir,
+                                             validate_threads=self.cfg.validate_threads(), download_threads=threads,
+                                             engine=engine, adaptive=self.cfg.adaptive_concurrency(),
+                                             deep=self.deep_verify.get(), backend=self.cfg.validate_backend())
+        else:
+            self.hash_handler.start_validating(threads=self.cfg.validate_threads(), wait=True,
+                                               adaptive=self.cfg.adaptive_concurrency(), deep=self.deep_verify.get(),
+                                               backend=self.cfg.validate_backend())
+            # Download the updated files
+            if self.hash_handler.get_downloads_total():
+                self.__mod_file_download_callback()
+                self.hash_handler.start_downloading(threads=threads, wait=True,
+                                                    callback=self.__mod_file_download_callback,
+                                                    destination=self.working_dir, engine=engine,
+                                                    adaptive=self.cfg.adaptive_concurrency())
+        # Check if there was anything to update
+        if not self.hash_handler.get_downloads_total():
+            self.set_progressbar_value()
+            self.hash_handler.record_installed()
             self.enable_input()
             self.status.set(self.lang.sta_already_updated())
             return
-        # Download the updated files
-        self.__mod_file_download_callback()
-        self.hash_handler.start_downloading(threads=2, wait=True, callback=self.__mod_file_download_callback,
-                                            destination=self.working_dir)
+        self.hash_handler.record_installed()
+        self.log.debug("Connection pool: " + json.dumps(self.hash_handler.get_pool_stats()))
         self.set_progressbar_value()
         self.status.set(self.lang.sta_download_complete(str(self.hash_handler.downloads_completed_counter)))
         self.load_launcher_image()
@@ -499,6 +529,11 @@ class Main:
         """Click handler for launch Windows Explorer to the currently set module dir"""
         subprocess.Popen("explorer.exe " + self.working_dir)
 
+    def set_deep_verify(self):
+        """Set and save whether to hash every file when checking for updates."""
+        if self.working_dir_valid:
+            self.cfg.deep_verify(set_value=self.deep_verify.get())
+
     def set_language(self):
         """Set the language of the launcher.  Save to a config if installed."""
         if not self.language == self.lang.lang_code:
@@ -567,10 +602,18 @@ class Main:
         request = urllib.request.Request(address)
         request.add_header("Content-Type", "application/x-www-form-urlencoded;charset=utf-8")
         try:
-            with urllib.request.urlopen(request, data) as r:
+            with self.connection_pool.urlopen(request, data, timeout=self.cfg.request_timeout()) as r:
                 return json.loads(r.read().decode("utf-8"))
         except urllib.error.HTTPError as e:
             self.log.error(str(e.code) + ": " + e.reason, tb=True)
+        except urllib.error.URLError as e:
+            self.log.error(str(e.reason), tb=True)
+
+    def __mod_file_pipeline_callback(self):
+        # The total grows as validation finds stale files, so the bar follows both stages together
+        self.set_progressbar_value(*self.hash_handler.get_progress())
+        self.status.set(self.lang.sta_download_progress(str(self.hash_handler.get_downloads_completed()),
+                                                        str(self.hash_handler.get_downloads_total())))
 
     def __mod_file_download_callback(self):
         self.set_progressbar_value(self.hash_handler.get_downloads_completed(), self.hash_handler.get_downloads_total())
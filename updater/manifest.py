@@ -0,0 +1,183 @@
+import binascii
+import json
+import struct
+import zlib
+
+MAGIC = b"NIMF"
+FORMAT_VERSION = 2
+
+_prefix_struct = struct.Struct("<4sBI")
+_body_struct = struct.Struct("<IIIII")
+
+# Per-file fields stored as binary columns, with the bit marking their presence in an entry's flags
+_SIZE = 1
+_CSIZE = 2
+_CODEC = 4
+
+
+def encode(manifest):
+    """ Encode a manifest into the compact format.
+
+    The header holds every top-level key except the file tree as plain JSON, so it can be read without touching the
+    file list.  The body is a zlib compressed set of columns: one line per directory listing its file names, the
+    concatenated binary digests of those files in the same order, a byte of flags per file saying which of size, csize
+    and codec it has, the sizes and compressed sizes as 64 bit integers, and the codecs as indexes into a table in the
+    header.  Any other fields, such as chunks, deltas and bundles, go in one JSON object keyed by file index.
+
+    :param dict manifest: The manifest, as written to the JSON file
+    :return bytes: The encoded manifest
+    """
+    directories = {}
+    for path, name, entry in _flatten(manifest["files"], []):
+        directories.setdefault(path, []).append((name, entry))
+    codecs = sorted({entry["codec"] for entries in directories.values() for name, entry in entries
+                     if isinstance(entry.get("codec"), str)})[:256]
+    codec_indexes = {codec: index for index, codec in enumerate(codecs)}
+    lines = []
+    digests = []
+    flags = bytearray()
+    sizes = []
+    csizes = []
+    codec_column = bytearray()
+    extras = {}
+    for path in sorted(directories):
+        names = []
+        for name, entry in sorted(directories[path], key=lambda item: item[0]):
+            extra = {key: value for key, value in entry.items() if key != "hash"}
+            flag = 0
+            if _is_size(extra.get("size")):
+                flag |= _SIZE
+                sizes.append(extra.pop("size"))
+            if _is_size(extra.get("csize")):
+                flag |= _CSIZE
+                csizes.append(extra.pop("csize"))
+            if extra.get("codec") in codec_indexes:
+                flag |= _CODEC
+                codec_column.append(codec_indexes[extra.pop("codec")])
+            if extra:
+                extras[len(digests)] = extra
+            flags.append(flag)
+            names.append(name)
+            digests.append(binascii.unhexlify(entry["hash"]))
+        lines.append("\t".join([path] + names))
+    header = {key: value for key, value in manifest.items() if key != "files"}
+    header["count"] = len(digests)
+    header["digest_size"] = len(digests[0]) if digests else 0
+    header["codecs"] = codecs
+    lines = "\n".join(lines).encode("utf-8")
+    extras = json.dumps(extras, separators=(",", ":"), sort_keys=True).encode("utf-8") if extras else b""
+    body = b"".join([_body_struct.pack(len(lines), len(extras), len(sizes), len(csizes), len(codec_column)),
+                     lines, extras, b"".join(digests), flags, struct.pack("<%dQ" % len(sizes), *sizes),
+                     struct.pack("<%dQ" % len(csizes), *csizes), codec_column])
+    header = json.dumps(header, separators=(",", ":"), sort_keys=True).encode("utf-8")
+    return _prefix_struct.pack(MAGIC, FORMAT_VERSION, len(header)) + header + zlib.compress(body, 9)
+
+
+def decode(data):
+    """ Decode a compact manifest back into the nested dictionary the JSON file holds.
+
+    :param bytes data: The encoded manifest
+    :return dict: The manifest
+    :raise ValueError: The data is not a compact manifest
+    """
+    manifest, offset = _read_header(data)
+    count = manifest.pop("count")
+    digest_size = manifest.pop("digest_size")
+    codecs = manifest.pop("codecs")
+    try:
+        body = zlib.decompress(data[offset:])
+        lines_length, extras_length, size_count, csize_count, codec_count = _body_struct.unpack_from(body)
+        offset = _body_struct.size
+        lines = body[offset:offset + lines_length].decode("utf-8").split("\n") if count else []
+        offset += lines_length
+        extras = json.loads(body[offset:offset + extras_length].decode("utf-8")) if extras_length else {}
+        offset += extras_length
+        digests = binascii.hexlify(body[offset:offset + count * digest_size]).decode("ascii")
+        offset += count * digest_size
+        flags = body[offset:offset + count]
+        offset += count
+        sizes = struct.unpack_from("<%dQ" % size_count, body, offset)
+        offset += size_count * 8
+        csizes = struct.unpack_from("<%dQ" % csize_count, body, offset)
+        offset += csize_count * 8
+        codec_column = [codecs[index] for index in body[offset:offset + codec_count]]
+        offset += codec_count
+    except (zlib.error, struct.error, IndexError) as e:
+        raise ValueError("Corrupt manifest: " + str(e))
+    if len(flags) != count or len(codec_column) != codec_count or offset != len(body):
+        raise ValueError("Truncated manifest")
+    # Build every entry in one pass, then hang them off their directories a directory at a time
+    step = digest_size * 2
+    offsets = range(0, len(digests), step or 1)
+    if size_count == csize_count == codec_count == count:
+        # Every packager entry has all three columns, so build them straight into the entries
+        entries = [{"hash": digests[index:index + step], "size": size, "csize": csize, "codec": codec}
+                   for index, size, csize, codec in zip(offsets, sizes, csizes, codec_column)]
+    else:
+        entries = [{"hash": digests[index:index + step]} for index in offsets]
+        for key, flag, values in [("size", _SIZE, sizes), ("csize", _CSIZE, csizes), ("codec", _CODEC, codec_column)]:
+            owners = [entry for entry, bits in zip(entries, flags) if bits & flag]
+            if len(owners) != len(values):
+                raise ValueError("Truncated manifest")
+            for entry, value in zip(owners, values):
+                entry[key] = value
+    for index in extras:
+        entries[int(index)].update(extras[index])
+    files = {}
+    index = 0
+    for line in lines:
+        names = line.split("\t")
+        node = files
+        if names[0]:
+            for key in names[0].split("/"):
+                node = node.setdefault(key, {})
+        node.update(zip(names[1:], entries[index:index + len(names) - 1]))
+        index += len(names) - 1
+    if index != count:
+        raise ValueError("Truncated manifest")
+    manifest["files"] = files
+    return manifest
+
+
+def is_compact(data):
+    """ Check whether some data is a compact manifest.
+
+    :param bytes data: The data to check
+    :return bool:
+    """
+    return data[:len(MAGIC)] == MAGIC
+
+
+def read_header(data):
+    """ Read only the header of a compact manifest, skipping the file list.
+
+    :param bytes data: The encoded manifest, or at least its start
+    :return dict: Every top-level manifest key except the file tree
+    :raise ValueError: The data is not a compact manifest
+    """
+    return _read_header(data)[0]
+
+
+def _is_size(value):
+    """ Check whether a field fits the unsigned 64 bit size columns. """
+    return type(value) is int and 0 <= value < 1 << 64
+
+
+def _flatten(files, path):
+    """ Yield a (directory, name, entry) triple for every file in a manifest's file tree. """
+    for key in files:
+        if "hash" in files[key]:
+            yield "/".join(path), key, files[key]
+        else:
+            yield from _flatten(files[key], path + [key])
+
+
+def _read_header(data):
+    """ Return the decoded header and the offset of the body. """
+    if len(data) < _prefix_struct.size or not is_compact(data):
+        raise ValueError("Not a compact manifest")
+    magic, format_version, header_length = _prefix_struct.unpack_from(data)
+    if format_version != FORMAT_VERSION:
+        raise ValueError("Unsupported manifest format " + str(format_version))
+    offset = _prefix_struct.size + header_length
+    return json.loads(data[_prefix_struct.size:offset].decode("utf-8")), offset
@@ -0,0 +1,90 @@
+import threading
+import time
+
+
+class MirrorScheduler:
+
+    smoothing = 0.3
+    max_penalty = 60
+
+    def __init__(self, hosts):
+        """ Spread downloads across every mirror serving the same version.
+
+        :param list hosts: The mirror hosts, best first
+        """
+        self.hosts = list(hosts)
+        self.lock = threading.Lock()
+        self.stats = {host: {"throughput": None, "active": 0, "failures": 0, "disabled_until": 0, "bytes": 0}
+                      for host in self.hosts}
+
+    def choose(self, exclude=None):
+        """ Pick the mirror expected to give the next download the most bandwidth.
+
+        A mirror's measured throughput is shared between the downloads already running on it.  Mirrors which have not
+        been measured yet are tried first, and mirrors which recently failed are skipped until their penalty runs out.
+
+        :param list exclude: Hosts to avoid if any other is available
+        :return str: The chosen host
+        """
+        with self.lock:
+            now = time.monotonic()
+            candidates = [host for host in self.hosts if self.stats[host]["disabled_until"] <= now and
+                          (not exclude or host not in exclude)]
+            if not candidates:
+                # Everything is failing, so go with whichever mirror recovers first
+                candidates = sorted(self.hosts, key=lambda host: self.stats[host]["disabled_until"])[:1]
+            host = max(candidates, key=self.__score)
+            self.stats[host]["active"] += 1
+            return host
+
+    def fail(self, host):
+        """ Record a failed download and take the mirror out of rotation for a while.
+
+        :param str host: The mirror's host
+        :return:
+        """
+        with self.lock:
+            stats = self.stats[host]
+            stats["active"] -= 1
+            stats["failures"] += 1
+            stats["disabled_until"] = time.monotonic() + min(2 ** stats["failures"], self.max_penalty)
+
+    def cancel(self, host):
+        """ Record a download which was abandoned through no fault of the mirror, such as a losing hedged request.
+
+        :param str host: The mirror's host
+        :return:
+        """
+        with self.lock:
+            self.stats[host]["active"] -= 1
+
+    def finish(self, host, size, seconds):
+        """ Record a successful download.
+
+        :param str host: The mirror's host
+        :param int size: The number of bytes downloaded
+        :param float seconds: How long the download took
+        :return:
+        """
+        with self.lock:
+            stats = self.stats[host]
+            stats["active"] -= 1
+            stats["failures"] = 0
+            stats["bytes"] += size
+            throughput = size / max(seconds, 1e-6)
+            if stats["throughput"] is None:
+                stats["throughput"] = throughput
+            else:
+                stats["throughput"] += self.smoothing * (throughput - stats["throughput"])
+
+    def __score(self, host):
+        stats = self.stats[host]
+        throughput = stats["throughput"]
+        if throughput is None:
+            # Give an unmeasured mirror one download to measure, then assume it is average
+            measured = [self.stats[other]["throughput"] for other in self.hosts
+                        if self.stats[other]["throughput"] is not None]
+            if stats["active"] == 0 or not measured:
+                return float("inf")
+            throughput = sum(measured) / len(measured)
+        return throughput / (stats["active"] + 1)
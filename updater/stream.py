@@ -0,0 +1,182 @@
+import json
+import os
+import updater.codec
+import updater.digest
+
+
+class VerifiedWriter:
+
+    def __init__(self, destination, codec, validation_hash, algorithm=updater.digest.DEFAULT_ALGORITHM):
+        """ Decompress, hash and write a download as it arrives, only putting it in place once it validates.
+
+        The file is written next to its destination and moved over it at the end, so a failed, corrupt or interrupted
+        download never replaces a good copy.  Once a download is marked resumable, the compressed data is also kept in a
+        .part file alongside a record of where it came from, so a later attempt can carry on from where this one
+        stopped.
+
+        :param str destination: The location to save the file
+        :param str codec: The codec the download is compressed with
+        :param str validation_hash: The hash to validate against
+        :param str algorithm: The algorithm the hash was made with
+        """
+        self.destination = destination
+        self.temp_path = destination + ".tmp"
+        self.part_path = destination + ".part"
+        self.meta_path = destination + ".part.json"
+        self.codec = codec
+        self.validation_hash = validation_hash
+        self.algorithm = algorithm
+        self.decompressor = updater.codec.StreamDecompressor(codec)
+        self.hash = updater.digest.new(algorithm)
+        self.received = 0
+        self.file = None
+        self.part_file = None
+        self.meta = None
+
+    def resume(self, block_size=1024 * 1024):
+        """ Pick up a partial download left by an earlier attempt, if it is for this version of the file.
+
+        The partial data is replayed from disk to rebuild the decompressor and hash, which is much quicker than
+        downloading it again.
+
+        :param int block_size: How much of the partial download to read at a time
+        :return dict: The record of the partial download, or None if there isn't a usable one
+        """
+        try:
+            with open(self.meta_path, 'rt') as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            meta = None
+        if not meta or meta.get("hash") != self.validation_hash or meta.get("codec") != self.codec or \
+                not os.path.exists(self.part_path):
+            self.abort()
+            return None
+        try:
+            with open(self.part_path, 'rb') as part_file:
+                for data in iter(lambda: part_file.read(block_size), b""):
+                    self.__process(data)
+        except ValueError:
+            self.reset()
+            return None
+        self.part_file = open(self.part_path, 'ab')
+        self.meta = meta
+        return meta
+
+    def record(self, meta):
+        """ Make the download resumable, recording where it comes from.
+
+        :param dict meta: The source of the download and its validators
+        :return:
+        """
+        if self.part_file is None:
+            if self.received:
+                # The data received so far wasn't kept, so there is nothing to resume from
+                return
+            if self.file is None:
+                self.__open()
+            self.part_file = open(self.part_path, 'wb')
+        self.meta = dict(meta, hash=self.validation_hash, codec=self.codec)
+        temp_path = self.meta_path + ".tmp"
+        with open(temp_path, 'wt') as file:
+            json.dump(self.meta, file)
+        os.replace(temp_path, self.meta_path)
+
+    def reset(self):
+        """ Throw away everything received so far and start again from the beginning.
+
+        :return:
+        """
+        self.abort()
+        self.decompressor = updater.codec.StreamDecompressor(self.codec)
+        self.hash = updater.digest.new(self.algorithm)
+        self.received = 0
+        self.meta = None
+
+    def write(self, data):
+        """ Add the next piece of the compressed download.
+
+        :param bytes data: The next piece of the download
+        :return:
+        :raise ValueError: The data could not be decompressed
+        """
+        if self.part_file is not None:
+            self.part_file.write(data)
+        self.__process(data)
+
+    def commit(self):
+        """ Validate the download and move it into place.
+
+        :return:
+        :raise ValueError: The download integrity could not be validated
+        """
+        if self.file is None:
+            self.__open()
+        try:
+            self.decompressor.check_complete()
+            if not self.hash.hexdigest() == self.validation_hash:
+                raise ValueError("Hash mismatch: " + self.destination)
+        except ValueError:
+            self.abort()
+            raise
+        # Make sure the data is on disk before it replaces the old copy
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.temp_path, self.destination)
+        self.__remove_partial()
+
+    def close(self):
+        """ Stop writing, keeping the partial download if it is resumable.
+
+        :return:
+        """
+        if self.part_file is None:
+            self.abort()
+            return
+        self.part_file.close()
+        self.part_file = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def abort(self):
+        """ Throw away whatever has been written so far, including any partial download.
+
+        :return:
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        self.__remove_partial()
+
+    def __process(self, data):
+        """ Decompress, hash and write out the next piece of the download. """
+        if self.file is None:
+            self.__open()
+        try:
+            output = self.decompressor.decompress(data)
+        except Exception as e:
+            # Corrupt data can't be resumed from, so start the next attempt from scratch
+            self.abort()
+            raise ValueError("Corrupt download: " + self.destination) from e
+        self.received += len(data)
+        self.hash.update(output)
+        self.file.write(output)
+
+    def __open(self):
+        folder = os.path.split(self.temp_path)[0]
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.file = open(self.temp_path, 'wb')
+
+    def __remove_partial(self):
+        if self.part_file is not None:
+            self.part_file.close()
+            self.part_file = None
+        for path in (self.part_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
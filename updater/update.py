@@ -7,19 +7,25 @@ import subprocess
 import sys
 import urllib.error
 import urllib.request
+import updater.connection
 
 
 class UpdateHandler:
 
-    def __init__(self, logging):
+    timeout = 30
+
+    def __init__(self, logging, pool=None, timeout=None):
         self.log = logging
         self.update_address = None
+        if timeout:
+            self.timeout = timeout
 
         self.script_path = sys.argv[0]
         self.script_dir, self.script_name = os.path.split(self.script_path)
 
         self.ssl_context = ssl.create_default_context()
         self.ssl_context.load_verify_locations(certifi.where())
+        self.pool = pool or updater.connection.ConnectionPool(self.ssl_context)
 
     def get_version_available(self, address):
         """Get information about the latest version of the updater.
@@ -29,12 +35,14 @@ class UpdateHandler:
         self.log.debug("get_version_available", address, func=True)
         request = urllib.request.Request(address)
         try:
-            with urllib.request.urlopen(request) as r:
+            with self.pool.urlopen(request, timeout=self.timeout) as r:
                 updater = json.loads(r.read().decode("utf-8"))
                 self.update_address = updater["address"]
                 return updater["version"]
         except urllib.error.HTTPError as e:
             self.log.error(str(e.code) + ": " + e.reason, tb=True)
+        except urllib.error.URLError as e:
+            self.log.error(str(e.reason), tb=True)
 
     def get_update(self):
         """ Download the latest version of the updater.
@@ -42,7 +50,8 @@ class UpdateHandler:
         :return:
         """
         self.log.debug("get_update", func=True)
-        data = urllib.request.urlopen(self.update_address, context=self.ssl_context).read()
+        with self.pool.urlopen(self.update_address, timeout=self.timeout) as r:
+            data = r.read()
         self.log.debug("downloaded updater")
         output_path = os.path.join(self.script_dir, "_" + self.script_name)
         with open(output_path, 'wb') as file: